@@ -37,7 +37,7 @@ build_inference() {
     local DIST_DIR="../output/inference_bootstrap"
     local BOOTSTRAP="../app/inference_client/bootstrap.py"
     local SRC_DIR="../app/inference_client"
-    local FILES=(main.py model_service.py requirements.txt)
+    local FILES=(main.py model_service.py scheduler.py caches.py generation.py imaging.py preprocess.py replicas.py cpu_config.py metrics.py warmup.py benchmark.py requirements.txt)
 
     local LIBPYTHON
         LIBPYTHON=$(
@@ -14,6 +14,7 @@ from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool
 
 from hypervisor import Hypervisor
 from display_utils import RUNNING
@@ -120,36 +121,209 @@ def get_hypervisor(request: Request) -> Hypervisor:
     return inferencevisor
 
 
-def sse_format_generator(generator):
-    """Format a generator as Server-Sent Events."""
-    for item in generator:
-        try:
-            # If the item is already JSON, just add the data: prefix
-            json_obj = json.loads(item)
-            yield f"data: {json.dumps(json_obj)}\n\n"
-        except json.JSONDecodeError:
-            # If it's not valid JSON, wrap it in a chunk object
-            yield f"data: {json.dumps({'chunk': item})}\n\n"
+def is_raw_image(content_type: str) -> bool:
+    """Whether the request body is the image itself rather than JSON."""
+    content_type = content_type.lower()
+    return content_type.startswith("application/octet-stream") or (
+        content_type.startswith("image/")
+    )
+
+
+def server_timing_total(header: str) -> float:
+    """The ``total`` duration (ms) of a Server-Timing header, or 0."""
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        if name == "total":
+            for param in params.split(";"):
+                key, _, value = param.partition("=")
+                if key.strip() == "dur":
+                    try:
+                        return float(value)
+                    except ValueError:
+                        return 0.0
+    return 0.0
+
+
+def merge_server_timing(upstream: str, start: float) -> str:
+    """Append the time spent in the hypervisor to the inference server's
+    Server-Timing header."""
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    proxy_ms = max(0.0, elapsed_ms - server_timing_total(upstream))
+    proxy = f'proxy;dur={proxy_ms:.2f};desc="hypervisor"'
+    return f"{upstream}, {proxy}" if upstream else proxy
+
+
+# Static framing of relayed chunk events, around the JSON-encoded text.
+SSE_CHUNK_START = 'data: {"chunk": '
+SSE_EVENT_END = "}\n\n"
+
+
+def parse_event(item: str, start: float = None) -> dict:
+    """Parse one upstream payload into an event object.
+
+    With ``start`` the inference server's ``timings`` event gains a ``proxy``
+    entry for the time spent in the hypervisor.
+    """
+    try:
+        # If the item is already JSON, use it as is
+        json_obj = json.loads(item)
+    except json.JSONDecodeError:
+        # If it's not valid JSON, wrap it in a chunk object
+        return {"chunk": item}
+    if start is not None and isinstance(json_obj, dict):
+        timings = json_obj.get("timings")
+        if isinstance(timings, dict):
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            timings["proxy"] = round(
+                max(0.0, elapsed_ms - timings.get("total", 0.0)), 2
+            )
+    return json_obj
+
+
+async def sse_format_generator(
+    payloads, start: float = None, flush_ms: float = 0, flush_chunks: int = 1
+):
+    """Format upstream payloads as Server-Sent Events.
+
+    Consecutive ``chunk`` events are merged: the first is sent at once, later
+    ones are flushed when ``flush_chunks`` have gathered or ``flush_ms`` has
+    passed since the previous flush. Any other event flushes pending text
+    first. ``flush_ms`` of 0 relays every chunk on its own.
+    """
+    loop = asyncio.get_running_loop()
+    pending = []
+    flushed_at = None
+    next_item = None
+    iterator = payloads.__aiter__()
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(iterator.__anext__())
+            timeout = None
+            if pending:
+                timeout = max(0.0, flushed_at + flush_ms / 1000 - loop.time())
+            done, _ = await asyncio.wait((next_item,), timeout=timeout)
+            event = None
+            if done:
+                task, next_item = next_item, None
+                try:
+                    event = parse_event(task.result(), start)
+                except StopAsyncIteration:
+                    break
+                chunk = event.get("chunk") if isinstance(event, dict) else None
+                if isinstance(chunk, str) and len(event) == 1:
+                    pending.append(chunk)
+                    event = None
+                    if (
+                        flush_ms > 0
+                        and flushed_at is not None
+                        and len(pending) < flush_chunks
+                    ):
+                        continue
+            if pending:
+                text = "".join(pending)
+                pending.clear()
+                flushed_at = loop.time()
+                yield SSE_CHUNK_START + json.dumps(text) + SSE_EVENT_END
+            if event is not None:
+                yield f"data: {json.dumps(event)}\n\n"
+        if pending:
+            yield SSE_CHUNK_START + json.dumps("".join(pending)) + SSE_EVENT_END
+    finally:
+        if next_item is not None:
+            next_item.cancel()
     yield f"data: {json.dumps({'completed': True})}\n\n"
 
 
+async def proxy_sse_stream(
+    generator, start: float = None, flush_ms: float = 0, flush_chunks: int = 1
+):
+    """Relay an upstream stream as SSE, closing it if the client disconnects.
+
+    A client disconnect cancels this generator after the current chunk; closing
+    the upstream stream then lets the inference server stop generating.
+    """
+    events = sse_format_generator(
+        iterate_in_threadpool(generator), start, flush_ms, flush_chunks
+    )
+    try:
+        async for event in events:
+            yield event
+    finally:
+        await events.aclose()
+        close = getattr(generator, "close", None)
+        if close is not None:
+            close()
+
+
+def remaining_deadline(request: Request, start: float) -> dict:
+    """``X-Deadline-Ms`` header for the inference server, if the client sent one.
+
+    The time already spent in the hypervisor is taken off the budget.
+    """
+    value = request.headers.get("x-deadline-ms")
+    if value is None:
+        return {}
+    try:
+        remaining = float(value) - (time.perf_counter() - start) * 1000
+    except ValueError:
+        # Pass it on unchanged and let the inference server reject it.
+        return {"X-Deadline-Ms": value}
+    return {"X-Deadline-Ms": f"{max(remaining, 1.0):.1f}"}
+
+
 async def proxy_inference_request(
     request: Request, endpoint: str, hypervisor: Hypervisor
 ):
     """Generic handler that proxies requests to the inference server."""
-    request_data = await request.json()
-    stream = request_data.get("stream", False)
+    start = time.perf_counter()
+    content_type = request.headers.get("content-type", "")
+    if is_raw_image(content_type):
+        # Raw image uploads are forwarded unchanged, together with their
+        # query string and X-Moondream-* parameter headers.
+        request_data = None
+        stream = (
+            request.query_params.get("stream")
+            or request.headers.get("x-moondream-stream", "false")
+        ).lower() in ("1", "true", "yes")
+        raw_headers = {
+            key: value
+            for key, value in request.headers.items()
+            if key.startswith("x-moondream-")
+        }
+        raw_headers["Content-Type"] = content_type
+        proxy_kwargs = {
+            "raw_body": await request.body(),
+            "raw_headers": raw_headers,
+            "params": dict(request.query_params),
+        }
+    else:
+        request_data = await request.json()
+        stream = request_data.get("stream", False)
+        proxy_kwargs = {}
+    proxy_kwargs["extra_headers"] = remaining_deadline(request, start)
 
     if stream:
         generator = hypervisor.inferencevisor.proxy_request(
-            endpoint, request_data, stream=True
+            endpoint, request_data, stream=True, **proxy_kwargs
         )
         return StreamingResponse(
-            sse_format_generator(generator), media_type="text/event-stream"
+            proxy_sse_stream(
+                generator,
+                start,
+                getattr(request.app.state, "stream_flush_ms", 0),
+                getattr(request.app.state, "stream_flush_chunks", 8),
+            ),
+            media_type="text/event-stream",
         )
     else:
+        upstream_headers = {}
         result = hypervisor.inferencevisor.proxy_request(
-            endpoint, request_data, stream=False
+            endpoint,
+            request_data,
+            stream=False,
+            response_headers=upstream_headers,
+            **proxy_kwargs,
         )
 
         if isinstance(result, Generator):
@@ -171,7 +345,10 @@ async def proxy_inference_request(
                 status_code=result.get("status_code", 500), detail=result["error"]
             )
 
-        return JSONResponse(result)
+        server_timing = merge_server_timing(
+            upstream_headers.get("server-timing", ""), start
+        )
+        return JSONResponse(result, headers={"Server-Timing": server_timing})
 
 
 # -------------------- Inference --------------------
@@ -450,9 +627,25 @@ def main():
         default="http://localhost:20200/v1",
         help="URL of the inference server",
     )
+    parser.add_argument(
+        "--stream-flush-ms",
+        type=float,
+        default=0,
+        help="Longest a relayed chunk waits to be merged with later ones. The "
+        "inference server already coalesces its stream, so the default 0 "
+        "relays every chunk as it arrives",
+    )
+    parser.add_argument(
+        "--stream-flush-chunks",
+        type=int,
+        default=8,
+        help="Relayed chunks that trigger an immediate flush",
+    )
     args = parser.parse_args()
 
     app.state.inference_url = args.inference_url
+    app.state.stream_flush_ms = args.stream_flush_ms
+    app.state.stream_flush_chunks = args.stream_flush_chunks
 
     logger.info(f"Starting hypervisor server on port: {args.port}")
     logger.info(f"Using inference server at: {args.inference_url}")
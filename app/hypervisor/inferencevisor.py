@@ -20,6 +20,55 @@ logger = logging.getLogger("hypervisor")
 PLATFORM = check_platform()
 
 
+class ProxyStream:
+    """
+    Streams the data payloads of an inference server SSE response.
+
+    The upstream request is made on first iteration. ``close`` drops the
+    upstream connection, which the inference server sees as a disconnect and
+    uses to stop generating.
+    """
+
+    def __init__(self, url: str, headers: Dict[str, str], post_kwargs: Dict[str, Any]):
+        self.url = url
+        self.headers = headers
+        self.post_kwargs = post_kwargs
+        self.response = None
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            self.response = requests.post(
+                self.url, headers=self.headers, stream=True, **self.post_kwargs
+            )
+            if self.response.status_code != 200:
+                logger.error(
+                    f"Error from inference server: {self.response.status_code}, {self.response.text}"
+                )
+                yield json.dumps(
+                    {"error": f"Inference server error: {self.response.status_code}"}
+                )
+                return
+            for line in self.response.iter_lines():
+                if self.closed:
+                    return
+                # Lines prefixed with "data: " contain the actual data, we remove "data: "
+                if line and line.startswith(b"data: "):
+                    yield line.decode("utf-8")[6:]
+        except Exception as e:
+            if self.closed:
+                return
+            logger.error(f"Error making inference request: {str(e)}")
+            yield json.dumps({"error": f"Request failed: {str(e)}"})
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        if self.response is not None:
+            self.response.close()
+
+
 class InferenceVisor:
     """
     Manages the inference server component of Moondream Station.
@@ -124,8 +173,8 @@ class InferenceVisor:
                 timeout_seconds = timeout_minutes * 60
 
                 while True:
-                    health_status = self.check_health()
-                    if health_status.get("inference_server") == "healthy":
+                    ready_status = self.check_ready()
+                    if ready_status.get("inference_server") == "ready":
                         break
 
                     # Check if we've timed out
@@ -229,49 +278,54 @@ class InferenceVisor:
             return False
 
     def proxy_request(
-        self, endpoint: str, request_data: Dict[str, Any], stream: bool = False
-    ) -> Union[Dict[str, Any], Generator[str, None, None]]:
+        self,
+        endpoint: str,
+        request_data: Optional[Dict[str, Any]],
+        stream: bool = False,
+        raw_body: Optional[bytes] = None,
+        raw_headers: Optional[Dict[str, str]] = None,
+        params: Optional[Dict[str, str]] = None,
+        response_headers: Optional[Dict[str, str]] = None,
+        extra_headers: Optional[Dict[str, str]] = None,
+    ) -> Union[Dict[str, Any], ProxyStream, Generator[str, None, None]]:
         """Pass request directly to the inference server and return the response.
 
         Args:
             endpoint: The API endpoint to call (without the base URL)
-            request_data: The request payload to send
+            request_data: The JSON request payload to send
             stream: Whether to return a streaming response
+            raw_body: Raw image body to forward unchanged instead of JSON
+            raw_headers: Headers to forward with ``raw_body``
+            params: Query string parameters to forward with ``raw_body``
+            response_headers: Filled with the inference server's response
+                headers, keyed in lower case, for non-streaming requests
+            extra_headers: Additional headers to send, e.g. ``X-Deadline-Ms``
 
         Returns:
             For non-streaming requests: A dictionary with the response
-            For streaming requests: A generator yielding response chunks
+            For streaming requests: A ProxyStream yielding response chunks
         """
         url = f"{self.inference_url}/{endpoint}"
-        headers = {"Content-Type": "application/json"}
+        if raw_body is not None:
+            headers = raw_headers or {}
+            post_kwargs = {"data": raw_body, "params": params}
+        else:
+            headers = {"Content-Type": "application/json"}
+            post_kwargs = {"json": request_data}
+        if extra_headers:
+            headers = {**headers, **extra_headers}
 
         try:
             if stream:
-                # For streaming responses, return a generator that yields chunks
-                def generate_stream():
-                    with requests.post(
-                        url, json=request_data, headers=headers, stream=True
-                    ) as response:
-                        if response.status_code == 200:
-                            for line in response.iter_lines():
-                                if line:
-                                    # Lines prefixed with "data: " contain the actual data, we remove "data: "
-                                    if line.startswith(b"data: "):
-                                        yield line.decode("utf-8")[6:]
-                        else:
-                            logger.error(
-                                f"Error from inference server: {response.status_code}, {response.text}"
-                            )
-                            yield json.dumps(
-                                {
-                                    "error": f"Inference server error: {response.status_code}"
-                                }
-                            )
-
-                return generate_stream()
+                # For streaming responses, return an iterator over the chunks
+                return ProxyStream(url, headers, post_kwargs)
             else:
                 # For non-streaming responses, return the JSON response as a dict
-                response = requests.post(url, json=request_data, headers=headers)
+                response = requests.post(url, headers=headers, **post_kwargs)
+                if response_headers is not None:
+                    response_headers.update(
+                        (key.lower(), value) for key, value in response.headers.items()
+                    )
 
                 if response.status_code == 200:
                     return response.json()
@@ -314,6 +368,35 @@ class InferenceVisor:
                 "details": str(e),
             }
 
+    def check_ready(self) -> Dict[str, Any]:
+        """Check if the inference server has finished warming up."""
+        try:
+            url = f"{self.inference_url}/ready"
+            response = requests.get(url)
+            if response.status_code == 404:
+                # Older inference clients have no readiness endpoint.
+                health_status = self.check_health()
+                if health_status.get("inference_server") == "healthy":
+                    health_status["inference_server"] = "ready"
+                return health_status
+            if response.status_code == 200:
+                return {
+                    "status": "ok",
+                    "inference_server": "ready",
+                    "warmup_s": response.json().get("warmup_s"),
+                }
+            return {
+                "status": "error",
+                "inference_server": "warming_up",
+                "details": response.text,
+            }
+        except Exception as e:
+            return {
+                "status": "error",
+                "inference_server": "unreachable",
+                "details": str(e),
+            }
+
     def set_inference_url(self, url: str) -> Dict[str, Any]:
         """Set a new inference server URL."""
         self.inference_url = url
@@ -0,0 +1,138 @@
+"""
+Compare model precisions on this host.
+
+Each precision is loaded in a fresh subprocess so resident memory is measured
+in isolation. Every run streams a caption for a synthetic image and reports
+load time, latency, decode throughput and memory.
+
+    python benchmark.py --precisions fp32,bf16,int8 --runs 5
+"""
+
+import argparse
+import json
+import logging
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+from model_service import PRECISIONS
+
+MODEL_NAME = "vikhyatk/moondream2"
+
+
+def _rss_mb() -> float:
+    """Current resident set size of this process in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / (1 << 20)
+    except OSError:
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def run_precision(precision: str, revision: str, runs: int, max_tokens: int) -> dict:
+    """Load one precision in this process and time streamed captions."""
+    from model_service import ModelService
+    from warmup import synthetic_image
+
+    service = ModelService(
+        MODEL_NAME, revision, embedding_cache_bytes=0, precision=precision
+    )
+    image = synthetic_image()
+    settings = {"max_tokens": max_tokens, "temperature": 0}
+
+    latencies, first_token, rates = [], [], []
+    for run in range(runs + 1):
+        start = time.perf_counter()
+        first = None
+        tokens = 0
+        for _ in service.caption(
+            image, length="normal", stream=True, settings=settings
+        )["caption"]:
+            if first is None:
+                first = time.perf_counter()
+            tokens += 1
+        end = time.perf_counter()
+        if run == 0:
+            continue  # The first run pays for lazy initialisation.
+        latencies.append((end - start) * 1000)
+        first_token.append(((first or end) - start) * 1000)
+        if tokens > 1 and first is not None:
+            rates.append((tokens - 1) / (end - first))
+
+    return {
+        "precision": precision,
+        "device": service.device,
+        "load_ms": round(service.load_timings["total"], 1),
+        "latency_ms": round(statistics.median(latencies), 1),
+        "first_token_ms": round(statistics.median(first_token), 1),
+        "tokens_per_s": round(statistics.median(rates), 2) if rates else None,
+        "rss_mb": round(_rss_mb(), 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Moondream precisions")
+    parser.add_argument(
+        "--precisions",
+        type=str,
+        default=",".join(PRECISIONS),
+        help="Comma separated precisions to compare",
+    )
+    parser.add_argument(
+        "--revision", type=str, default=None, help="Moondream revision to use"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs per precision")
+    parser.add_argument(
+        "--max-tokens", type=int, default=64, help="Caption length limit per run"
+    )
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        logging.disable(logging.INFO)
+        result = run_precision(args.worker, args.revision, args.runs, args.max_tokens)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for precision in args.precisions.split(","):
+        if precision not in PRECISIONS:
+            parser.error(f"Unknown precision '{precision}'")
+        cmd = [sys.executable, __file__, "--worker", precision]
+        cmd += ["--runs", str(args.runs), "--max-tokens", str(args.max_tokens)]
+        if args.revision:
+            cmd += ["--revision", args.revision]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1:] or ["unknown error"]
+            print(f"{precision}: failed ({error[0]})", file=sys.stderr)
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    columns = (
+        "precision",
+        "device",
+        "load_ms",
+        "latency_ms",
+        "first_token_ms",
+        "tokens_per_s",
+        "rss_mb",
+        "peak_rss_mb",
+    )
+    print("  ".join(f"{c:>14}" for c in columns))
+    for result in results:
+        print("  ".join(f"{str(result[c]):>14}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+import hashlib
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import torch
+from PIL import Image
+
+
+def new_digest():
+    """Incremental hasher matching ``bytes_digest``, for streamed uploads."""
+    return hashlib.blake2b(digest_size=16)
+
+
+def bytes_digest(data: bytes) -> str:
+    """Fast content hash of raw image bytes."""
+    digest = new_digest()
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def image_digest(image: Image.Image) -> str:
+    """Content hash of an image.
+
+    Uses the hash of the uploaded bytes recorded at decode time when present,
+    otherwise hashes the decoded pixels.
+    """
+    digest = image.info.get("content_hash")
+    if digest is None:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{image.mode}:{image.size}".encode())
+        h.update(image.tobytes())
+        digest = h.hexdigest()
+        image.info["content_hash"] = digest
+    return digest
+
+
+def shared_prefix(a: tuple, b: tuple) -> int:
+    """Number of leading items ``a`` and ``b`` have in common."""
+    shared = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        shared += 1
+    return shared
+
+
+def tensor_nbytes(value: Any) -> int:
+    """Total size in bytes of the tensors reachable from ``value``."""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(tensor_nbytes(v) for v in value.values())
+    if hasattr(value, "__dict__"):
+        return sum(tensor_nbytes(v) for v in vars(value).values())
+    return 0
+
+
+class EmbeddingCache:
+    """LRU cache of encoded images bounded by a memory budget in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max(0, max_bytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, nbytes: int):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            while self._entries and self.bytes + nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.bytes -= evicted_bytes
+                self.evictions += 1
+            self._entries[key] = (value, nbytes)
+            self.bytes += nbytes
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """Remove and return the entry for ``key``, without counting a lookup."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self.bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+class PrefixCache(EmbeddingCache):
+    """LRU cache of prompt key/value state, matched by longest shared prefix.
+
+    Keys are ``(context, tokens)``: ``context`` identifies the attention state
+    the prompt was prefilled on top of, i.e. the encoded image, and ``tokens``
+    is the tuple of prompt token ids. ``longest_prefix`` finds the entry in
+    the same context sharing the most leading tokens with a new prompt, so a
+    new question still reuses its template. Every reuse counts as a hit;
+    ``partial_hits`` are the reuses that covered only part of the prompt.
+
+    Prefill state is large, so it is only stored once it repeats: ``admit``
+    remembers the token ids of recent prompts and reports how much of a new
+    prompt an earlier one in the same context already shared.
+    """
+
+    # Recent prompts remembered by their token ids alone.
+    MAX_SEEN = 256
+
+    def __init__(self, max_bytes: int):
+        super().__init__(max_bytes)
+        self.partial_hits = 0
+        self.reused_tokens = 0
+        self._seen: "OrderedDict[Hashable, None]" = OrderedDict()
+
+    def longest_prefix(
+        self, context: Hashable, tokens: tuple
+    ) -> Tuple[Optional[Any], Optional[tuple], int]:
+        """Return ``(value, entry_tokens, shared)`` for the best match."""
+        best_key, best_shared = None, 0
+        with self._lock:
+            for key in self._entries:
+                if key[0] != context:
+                    continue
+                shared = shared_prefix(key[1], tokens)
+                if shared > best_shared:
+                    best_key, best_shared = key, shared
+            if best_key is None:
+                self.misses += 1
+                return None, None, 0
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            if best_key[1] != tokens:
+                self.partial_hits += 1
+            self.reused_tokens += best_shared
+            return self._entries[best_key][0], best_key[1], best_shared
+
+    def admit(self, context: Hashable, tokens: tuple) -> int:
+        """Record a prefilled prompt; return how many leading tokens to store.
+
+        That is the longest prefix it shares with a recent prompt in the same
+        context: all of it for a repeated prompt, typically the template for
+        a new question, and nothing the first time a prompt is seen.
+        """
+        key = (context, tokens)
+        with self._lock:
+            admitted = 0
+            for seen in self._seen:
+                if seen[0] == context:
+                    admitted = max(admitted, shared_prefix(seen[1], tokens))
+            self._seen.pop(key, None)
+            self._seen[key] = None
+            while len(self._seen) > self.MAX_SEEN:
+                self._seen.popitem(last=False)
+        return admitted
+
+    def discard_context(self, context: Hashable):
+        """Drop every entry prefilled on ``context``."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == context]:
+                self.bytes -= self._entries.pop(key)[1]
+            for key in [key for key in self._seen if key[0] == context]:
+                del self._seen[key]
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+        super().clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        snapshot = super().snapshot()
+        snapshot["partial_hits"] = self.partial_hits
+        snapshot["reused_tokens"] = self.reused_tokens
+        return snapshot
+
+
+class TokenizerCache:
+    """Tokenizer wrapper that caches prompt encodes and extends stream decodes.
+
+    Prompts repeat (questions, detect and point object names), so ``encode``
+    results are kept in an LRU keyed by text. Streaming decodes the growing
+    list of generated ids at every step; when ``decode`` sees the same list
+    object one id longer than last time, and the previous text ended on a
+    character boundary, it decodes only the newest id and appends its text,
+    so a step costs the same however long the sequence is. Each stream is
+    checked against a full decode whenever its length reaches a power of
+    two, and the shortcut is turned off if they ever differ. Everything else
+    passes through to the wrapped tokenizer.
+    """
+
+    # Streams decoding at once; each keeps only its latest text.
+    MAX_STREAMS = 256
+
+    def __init__(self, tokenizer, max_entries: int):
+        self.tokenizer = tokenizer
+        self.max_entries = max(0, max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.incremental_decodes = 0
+        self._incremental = True
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        # id(ids) -> (ids, length, text) for the latest decode of each stream.
+        self._streams: "OrderedDict[int, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        return getattr(self.tokenizer, name)
+
+    def encode(self, text, *args, **kwargs):
+        try:
+            key = (text, args, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            return self.tokenizer.encode(text, *args, **kwargs)
+        if not self.max_entries:
+            return self.tokenizer.encode(text, *args, **kwargs)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        encoded = self.tokenizer.encode(text, *args, **kwargs)
+        with self._lock:
+            self._entries[key] = encoded
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return encoded
+
+    def decode(self, ids, *args, **kwargs) -> str:
+        if args or kwargs or not self._incremental or not isinstance(ids, list):
+            return self.tokenizer.decode(ids, *args, **kwargs)
+        length = len(ids)
+        with self._lock:
+            stream = self._streams.pop(id(ids), None)
+        extends = (
+            stream is not None
+            and stream[0] is ids
+            and stream[1] == length - 1
+            and not stream[2].endswith("\ufffd")
+        )
+        if not extends:
+            text = self.tokenizer.decode(ids)
+        else:
+            text = stream[2] + self.tokenizer.decode(ids[-1:])
+            if length & (length - 1) == 0:
+                full = self.tokenizer.decode(ids)
+                if text != full:
+                    with self._lock:
+                        self._incremental = False
+                        self._streams.clear()
+                    return full
+        with self._lock:
+            if extends:
+                self.incremental_decodes += 1
+            if self._incremental:
+                self._streams[id(ids)] = (ids, length, text)
+                while len(self._streams) > self.MAX_STREAMS:
+                    self._streams.popitem(last=False)
+        return text
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._streams.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "incremental_decodes": self.incremental_decodes,
+            "incremental_decode_enabled": self._incremental,
+        }
+
+
+def merge_snapshots(snapshots: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine the stats of one cache kept separately by each model replica."""
+    merged: Dict[str, Any] = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            if isinstance(value, bool):
+                merged[key] = merged.get(key, True) and value
+            else:
+                merged[key] = merged.get(key, 0) + value
+    if "hit_ratio" in merged:
+        lookups = merged["hits"] + merged["misses"]
+        merged["hit_ratio"] = round(merged["hits"] / lookups, 4) if lookups else 0.0
+    return merged
+
+
+def is_deterministic(task: str, settings: Optional[dict]) -> bool:
+    """Whether a request always produces the same result for the same input.
+
+    Detect and point decode greedily; captions and queries only do so when
+    sampling is disabled with ``temperature`` 0.
+    """
+    if task in ("detect", "point"):
+        return True
+    return (settings or {}).get("temperature") == 0
+
+
+class ResponseCache:
+    """LRU cache of complete task results with a per-entry time to live."""
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max(0, max_entries)
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_hash: str, task: str, kwargs: dict, revision: str) -> str:
+        params = json.dumps(kwargs, sort_keys=True, default=str)
+        return f"{revision}|{task}|{image_hash}|{params}"
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (value, time.monotonic() + self.ttl_s)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,220 @@
+import glob
+import logging
+import os
+
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("moondream2")
+
+SYSFS_CPU = "/sys/devices/system/cpu"
+SYSFS_NODE = "/sys/devices/system/node"
+
+
+@dataclass
+class ReplicaPlan:
+    """CPUs and torch thread counts for one model worker."""
+
+    cpus: Optional[List[int]]
+    physical_cores: int
+    intra_op_threads: int
+    inter_op_threads: int
+    numa_nodes: List[int] = field(default_factory=list)
+
+
+@dataclass
+class CpuLayout:
+    logical_cpus: int
+    physical_cores: int
+    numa_nodes: int
+    pinned: bool
+    replicas: List[ReplicaPlan]
+    # CPUs left for the event loop, image decoding and neighbouring processes.
+    aux_cpus: Optional[List[int]]
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _parse_cpulist(text: str) -> List[int]:
+    """Parse a sysfs cpu list such as ``0-3,8-11``."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def allowed_cpus() -> List[int]:
+    """Logical CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def detect_topology() -> Dict[int, List[List[int]]]:
+    """Map each NUMA node to its physical cores, each a list of logical CPUs.
+
+    Only CPUs in this process's affinity mask are included. Without sysfs
+    (e.g. macOS) every logical CPU is treated as a physical core on node 0.
+    """
+    cpu_node = {}
+    for node_dir in glob.glob(os.path.join(SYSFS_NODE, "node[0-9]*")):
+        node = int(os.path.basename(node_dir)[4:])
+        try:
+            with open(os.path.join(node_dir, "cpulist")) as f:
+                for cpu in _parse_cpulist(f.read()):
+                    cpu_node[cpu] = node
+        except OSError:
+            continue
+
+    cores: Dict[tuple, List[int]] = {}
+    for cpu in allowed_cpus():
+        topology = os.path.join(SYSFS_CPU, f"cpu{cpu}", "topology")
+        package = _read_int(os.path.join(topology, "physical_package_id"))
+        core = _read_int(os.path.join(topology, "core_id"))
+        key = (cpu_node.get(cpu, 0), package, core if core is not None else cpu)
+        cores.setdefault(key, []).append(cpu)
+
+    nodes: Dict[int, List[List[int]]] = {}
+    for key in sorted(cores, key=lambda k: (k[0], min(cores[k]))):
+        nodes.setdefault(key[0], []).append(sorted(cores[key]))
+    return nodes
+
+
+def _split(items: list, parts: int) -> List[list]:
+    """Split ``items`` into ``parts`` contiguous chunks of near-equal size."""
+    size, extra = divmod(len(items), parts)
+    chunks, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def plan_layout(
+    replicas: int = 1,
+    reserved_cores: Optional[int] = None,
+    intra_op_threads: Optional[int] = None,
+    inter_op_threads: Optional[int] = None,
+    pin: bool = True,
+) -> CpuLayout:
+    """Plan thread counts and core sets for ``replicas`` model workers.
+
+    ``reserved_cores`` physical cores (by default one, on hosts with at least
+    four) are kept free of model work for the event loop, image decoding and
+    the hypervisor. A replica never straddles NUMA nodes unless there are
+    fewer nodes than replicas would need, and only runs on one logical CPU
+    per physical core so SMT siblings do not contend for the same units.
+    """
+    topology = detect_topology()
+    all_cores = [core for node in sorted(topology) for core in topology[node]]
+    logical = sum(len(core) for core in all_cores)
+    if reserved_cores is None:
+        reserved_cores = 1 if len(all_cores) >= 4 else 0
+    reserved_cores = min(reserved_cores, max(0, len(all_cores) - replicas))
+
+    # Take reserved cores from the end of the last node.
+    reserved = all_cores[len(all_cores) - reserved_cores :]
+    node_cores = {
+        node: [core for core in cores if core not in reserved]
+        for node, cores in topology.items()
+    }
+    node_cores = {node: cores for node, cores in node_cores.items() if cores}
+    nodes = sorted(node_cores)
+
+    assignments: List[tuple] = []
+    if replicas <= len(nodes):
+        for i in range(replicas):
+            owned = nodes[i::replicas]
+            assignments.append(
+                (owned, [core for node in owned for core in node_cores[node]])
+            )
+    else:
+        for i in range(replicas):
+            node = nodes[i % len(nodes)]
+            share = len(range(i % len(nodes), replicas, len(nodes)))
+            chunk = _split(node_cores[node], share)[i // len(nodes)]
+            assignments.append(([node], chunk or node_cores[node]))
+
+    plans = []
+    for owned, cores in assignments:
+        cpus = [core[0] for core in cores]
+        plans.append(
+            ReplicaPlan(
+                cpus=cpus if pin else None,
+                physical_cores=len(cores),
+                intra_op_threads=intra_op_threads or max(1, len(cores)),
+                inter_op_threads=inter_op_threads or 1,
+                numa_nodes=owned,
+            )
+        )
+    # Only whole reserved cores: the idle SMT siblings of model cores share
+    # their execution units with the intra-op threads. Without reserved cores
+    # auxiliary threads stay unpinned.
+    aux = [cpu for core in reserved for cpu in core]
+    return CpuLayout(
+        logical_cpus=logical,
+        physical_cores=len(all_cores),
+        numa_nodes=len(topology),
+        pinned=pin,
+        replicas=plans,
+        aux_cpus=aux if pin and aux else None,
+    )
+
+
+def pin_thread(cpus: Optional[List[int]], threads: Optional[int] = None):
+    """Pin the calling thread, and threads it later spawns, to ``cpus``.
+
+    Used as an executor initializer, so torch's OpenMP pool, which is created
+    by the first thread to run parallel work, inherits the affinity.
+    """
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    if threads:
+        import torch
+
+        torch.set_num_threads(threads)
+
+
+def apply_process_layout(layout: CpuLayout):
+    """Apply the process-wide torch settings of ``layout``."""
+    import torch
+
+    plan = layout.replicas[0]
+    if len(layout.replicas) > 1:
+        # The parent only loads the weights and coordinates; with a single
+        # intra-op thread no OpenMP pool exists when the replicas fork.
+        torch.set_num_threads(1)
+    else:
+        torch.set_num_threads(plan.intra_op_threads)
+    try:
+        torch.set_num_interop_threads(plan.inter_op_threads)
+    except RuntimeError:
+        # Only allowed once and before any inter-op work has started.
+        logger.debug("Inter-op thread count already fixed, leaving it unchanged")
+    for index, plan in enumerate(layout.replicas):
+        logger.info(
+            f"Model worker {index}: {plan.physical_cores} physical cores "
+            f"on NUMA nodes {plan.numa_nodes}, cpus {plan.cpus or 'unpinned'}, "
+            f"{plan.intra_op_threads} intra-op / {plan.inter_op_threads} inter-op threads"
+        )
+    logger.info(
+        f"CPU layout: {layout.physical_cores} physical cores, "
+        f"{layout.logical_cpus} logical, {layout.numa_nodes} NUMA nodes; "
+        f"auxiliary cpus {layout.aux_cpus or 'unpinned'}"
+    )
@@ -0,0 +1,490 @@
+"""
+Iteration-level generation engine.
+
+Caption and query sequences join a single decode loop per model instance.
+Each iteration advances every active sequence by one step, new sequences are
+admitted between iterations and finished ones leave immediately, so a short
+answer no longer waits for a long caption to complete.
+
+The model's remote code decodes one sequence at a time against a batch-1
+key/value cache held on each text block. The engine gives every sequence its
+own key/value buffers, taken from a preallocated ``KVCachePool``, and binds
+them to the blocks before stepping it, which lets sequences interleave without
+copying their attention state.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+
+from caches import tensor_nbytes
+
+logger = logging.getLogger("moondream2")
+
+# Result key holding the generated text, per generation task.
+STREAM_KEYS = {"caption": "caption", "query": "answer"}
+
+
+def _kv_caches(model) -> Optional[list]:
+    """The per-block key/value caches of the model's text decoder, if any."""
+    inner = getattr(model, "model", model)
+    blocks = getattr(getattr(inner, "text", None), "blocks", None)
+    if not blocks:
+        return None
+    caches = [getattr(block, "kv_cache", None) for block in blocks]
+    if not all(
+        hasattr(cache, "k_cache") and hasattr(cache, "v_cache") for cache in caches
+    ):
+        return None
+    return caches
+
+
+def _fingerprint(caches: list, pos: int) -> bytes:
+    """Identify the attention state before ``pos``.
+
+    The keys at the last position of the first and last text blocks depend on
+    everything before them, so equal bytes mean the same encoded image.
+    """
+    rows = [cache.k_cache[..., pos - 1, :] for cache in (caches[0], caches[-1])]
+    return b"".join(row.float().cpu().numpy().tobytes() for row in rows)
+
+
+def image_context(encoded) -> Optional[tuple]:
+    """The prefix cache context of prompts about an encoded image.
+
+    Reads the same key rows as ``_fingerprint`` from the image's own caches,
+    without loading them into the model. None when the encoded image does not
+    expose them in the expected layout.
+    """
+    try:
+        pos = encoded.pos
+        rows = [
+            cache[0][..., pos - 1, :]
+            for cache in (encoded.caches[0], encoded.caches[-1])
+        ]
+        return pos, b"".join(row.float().cpu().numpy().tobytes() for row in rows)
+    except (AttributeError, IndexError, TypeError):
+        return None
+
+
+def install_prefix_cache(model, cache) -> bool:
+    """Serve prompt prefill from ``cache`` (a ``caches.PrefixCache``).
+
+    Wraps the remote code's ``_prefill_prompt``. When a prompt on the same
+    image starts with tokens already prefilled, their key/value rows are
+    copied back into the bound buffers and only the remaining tokens are run;
+    an exact match skips prefill altogether and only samples the first token
+    from the cached logits. Calls the wrapper does not understand, such as
+    spatial references, go straight to the original. A prompt is stored whole
+    when it repeats, and only its template (the prefix it shares with an
+    earlier prompt) otherwise; first sightings are not stored. Returns
+    whether the cache was installed.
+    """
+    inner = getattr(model, "model", model)
+    original = getattr(inner, "_prefill_prompt", None)
+    caches = _kv_caches(model)
+    if original is None or caches is None or not cache.max_bytes:
+        return False
+    enabled = [True]
+
+    def sample(logits, temperature, top_p):
+        # Mirrors the remote code's choice of the first generated token.
+        if temperature == 0:
+            return torch.argmax(logits, dim=-1).unsqueeze(1)
+        probs = torch.softmax(logits / temperature, dim=-1)
+        probs = inner._apply_top_p(probs, top_p)
+        return torch.multinomial(probs, num_samples=1)
+
+    def store(context, tokens: tuple, length: int, pos: int, result):
+        logits, hidden, next_token, end = result
+        if sample(logits, 0, 0).shape != next_token.shape:
+            enabled[0] = False
+            logger.warning("Unexpected prefill output, disabling the prefix cache")
+            return
+        end = pos + length
+        kv = [
+            (c.k_cache[:, :, pos:end, :].clone(), c.v_cache[:, :, pos:end, :].clone())
+            for c in caches
+        ]
+        if length == len(tokens):
+            value = (kv, logits.clone(), hidden.clone())
+        else:
+            # Only the shared prefix: its key/value rows, but no logits.
+            value = (kv, None, None)
+        cache.put((context, tokens[:length]), value, tensor_nbytes(value))
+
+    def prefill_prompt(prompt_tokens, pos, temperature=0, top_p=0, *args, **kwargs):
+        if (
+            not enabled[0]
+            or args
+            or any(value is not None for value in kwargs.values())
+            or prompt_tokens.dim() != 2
+            or prompt_tokens.size(0) != 1
+            or pos < 1
+            or (temperature != 0 and not hasattr(inner, "_apply_top_p"))
+        ):
+            return original(prompt_tokens, pos, temperature, top_p, *args, **kwargs)
+
+        with torch.inference_mode():
+            tokens = tuple(prompt_tokens[0].tolist())
+            context = (pos, _fingerprint(caches, pos))
+            value, cached_tokens, shared = cache.longest_prefix(context, tokens)
+            if value is not None and (cached_tokens != tokens or value[1] is None):
+                # At least one token must run to produce this prompt's logits.
+                shared = min(shared, len(tokens) - 1)
+            if value is not None and shared > 0:
+                kv, logits, hidden = value
+                for c, (k, v) in zip(caches, kv):
+                    c.k_cache[:, :, pos : pos + shared, :] = k[:, :, :shared, :]
+                    c.v_cache[:, :, pos : pos + shared, :] = v[:, :, :shared, :]
+                if shared == len(tokens):
+                    next_token = sample(logits, temperature, top_p)
+                    return logits, hidden, next_token, pos + shared
+            else:
+                shared = 0
+
+        result = original(prompt_tokens[:, shared:], pos + shared, temperature, top_p)
+        if isinstance(result, tuple) and len(result) == 4:
+            with torch.inference_mode():
+                # Store the part of the prompt that has repeated, unless an
+                # entry already covers it.
+                length = cache.admit(context, tokens)
+                if length > shared:
+                    store(context, tokens, length, pos, result)
+        else:
+            enabled[0] = False
+            logger.warning("Unexpected prefill output, disabling the prefix cache")
+        return result
+
+    inner._prefill_prompt = prefill_prompt
+    return True
+
+
+class Sequence:
+    """One caption or query generation inside the engine.
+
+    Iterating a sequence yields its text chunks as the decode thread produces
+    them. Abandoning the iteration stops the sequence at its next step.
+    """
+
+    def __init__(self, task: str, image, kwargs: dict):
+        self.task = task
+        self.image = image
+        self.kwargs = kwargs
+        self.slot: Optional[int] = None
+        self.deferred = False
+        self.tokens = None
+        self.chunks: List[str] = []
+        self.error: Optional[BaseException] = None
+        self.cancelled = False
+        # Set when the sequence gets a key/value slot and joins the loop.
+        self.admitted_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.done = threading.Event()
+        self._changed = threading.Condition()
+
+    def _append(self, chunk: str):
+        with self._changed:
+            self.chunks.append(chunk)
+            self._changed.notify_all()
+
+    def _close(self, error: Optional[BaseException]):
+        with self._changed:
+            self.error = error
+            self.finished_at = time.perf_counter()
+            self.done.set()
+            self._changed.notify_all()
+
+    def __iter__(self) -> Iterator[str]:
+        index = 0
+        try:
+            while True:
+                with self._changed:
+                    while index == len(self.chunks) and not self.done.is_set():
+                        self._changed.wait()
+                    chunks = self.chunks[index:]
+                    finished = self.done.is_set()
+                index += len(chunks)
+                yield from chunks
+                if finished and index == len(self.chunks):
+                    break
+        finally:
+            if not self.done.is_set():
+                self.cancelled = True
+        if self.error is not None:
+            raise self.error
+
+    def result(self) -> str:
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return "".join(self.chunks)
+
+
+class KVCachePool:
+    """Preallocated key/value buffers for a fixed number of sequences.
+
+    Each slot holds a full-context buffer pair per text block, shaped like the
+    model's own caches. Slots are allocated and zeroed once, on first use in
+    the decoding process, then handed from finished sequences to new ones
+    without clearing: positions past a sequence's length are masked out of
+    attention, so stale values never contribute.
+
+    The remote code needs contiguous full-context buffers, so there is no
+    external fragmentation; ``fragmentation`` reports the share of reserved
+    positions that active sequences are not using.
+    """
+
+    def __init__(self, template: List[Tuple[torch.Tensor, torch.Tensor]], slots: int):
+        self.template = template
+        self.slots = max(1, slots)
+        k = template[0][0]
+        self.max_positions = k.shape[2] if k.dim() > 2 else 1
+        self._buffers: Optional[list] = None
+        self._free: List[int] = []
+        # Slot -> positions its sequence has filled so far.
+        self._used: Dict[int, int] = {}
+        # Slots change hands on the decode thread; stats are read elsewhere.
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.deferred = 0
+
+    def slot_bytes(self) -> int:
+        return sum(k.nbytes + v.nbytes for k, v in self.template)
+
+    def _preallocate(self):
+        # Zeroed rather than empty: masked positions still enter the attention
+        # sum with zero weight, and uninitialised memory may hold NaNs.
+        self._buffers = [
+            [(torch.zeros_like(k), torch.zeros_like(v)) for k, v in self.template]
+            for _ in range(self.slots)
+        ]
+        self._free = list(range(self.slots))
+        logger.info(
+            f"Allocated {self.slots} key/value slots, "
+            f"{self.slots * self.slot_bytes() / (1 << 20):.0f} MB in total"
+        )
+
+    @property
+    def free(self) -> int:
+        return self.slots if self._buffers is None else len(self._free)
+
+    def acquire(self) -> Optional[int]:
+        """Take a free slot, or return None when all are in use."""
+        if self._buffers is None:
+            self._preallocate()
+        with self._lock:
+            if not self._free:
+                return None
+            slot = self._free.pop()
+            self._used[slot] = 0
+            self.acquired += 1
+            return slot
+
+    def defer(self):
+        """Count a sequence that had to wait for a slot."""
+        with self._lock:
+            self.deferred += 1
+
+    def buffers(self, slot: int) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        return self._buffers[slot]
+
+    def record(self, slot: int, positions: int):
+        with self._lock:
+            if slot in self._used:
+                self._used[slot] = min(positions, self.max_positions)
+
+    def release(self, slot: int):
+        with self._lock:
+            if self._used.pop(slot, None) is not None:
+                self._free.append(slot)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            in_use = len(self._used)
+            used = sum(self._used.values())
+        reserved = in_use * self.max_positions
+        return {
+            "slots": self.slots,
+            "in_use": in_use,
+            "free": self.slots - in_use,
+            "slot_bytes": self.slot_bytes(),
+            "allocated_bytes": (
+                self.slots * self.slot_bytes() if self._buffers is not None else 0
+            ),
+            "occupancy": round(in_use / self.slots, 4),
+            "fragmentation": round(1 - used / reserved, 4) if reserved else 0.0,
+            "acquired": self.acquired,
+            "deferred": self.deferred,
+        }
+
+
+class GenerationEngine:
+    """Runs caption and query generations for one model on a decode thread.
+
+    At most ``max_sequences`` sequences are active, fewer if ``kv_pool_bytes``
+    cannot hold that many key/value slots (0 lifts the cap); more wait to be
+    admitted.
+    Other model calls (image encoding, detect, point) must run inside
+    ``exclusive()``, which waits for the current decode step and restores the
+    model's own key/value buffers for the duration of the call.
+    """
+
+    def __init__(self, model, max_sequences: int = 1, kv_pool_bytes: int = 2048 << 20):
+        self.model = model
+        self._caches = _kv_caches(model)
+        if self._caches is None:
+            raise ValueError("Model has no per-block key/value caches")
+        self._own_kv = [(c.k_cache, c.v_cache) for c in self._caches]
+        slots = max(1, max_sequences)
+        if kv_pool_bytes > 0:
+            slots = max(1, min(slots, kv_pool_bytes // self.kv_bytes()))
+        self.pool = KVCachePool(self._own_kv, slots)
+        self.max_sequences = self.pool.slots
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._pending: deque = deque()
+        self._active: List[Sequence] = []
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self.steps = 0
+        self.completed = 0
+
+    @staticmethod
+    def supported(model) -> bool:
+        return _kv_caches(model) is not None
+
+    def kv_bytes(self) -> int:
+        """Memory taken by one sequence's key/value buffers."""
+        return sum(k.nbytes + v.nbytes for k, v in self._own_kv)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "max_sequences": self.max_sequences,
+            "active": len(self._active),
+            "pending": len(self._pending),
+            "steps": self.steps,
+            "completed": self.completed,
+            "kv_pool": self.pool.snapshot(),
+        }
+
+    @contextmanager
+    def exclusive(self):
+        """Run a non-generation model call between decode steps."""
+        with self._lock:
+            self._bind(self._own_kv)
+            yield
+
+    def start(self, task: str, image, kwargs: dict) -> Sequence:
+        """Queue a caption or query on an encoded image for the decode loop.
+
+        ``kwargs`` are passed to the model's ``caption`` or ``query``.
+        """
+        sequence = Sequence(task, image, kwargs)
+        with self._wakeup:
+            self._ensure_thread()
+            self._pending.append(sequence)
+            self._wakeup.notify()
+        return sequence
+
+    def _ensure_thread(self):
+        # Threads do not survive fork, so replicas start their own. Created
+        # from a model worker thread, the decode thread inherits its pinning.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._loop, name="moondream-decode", daemon=True
+        )
+        self._thread.start()
+
+    def _bind(self, kv: List[Tuple[torch.Tensor, torch.Tensor]]):
+        for cache, (k, v) in zip(self._caches, kv):
+            cache.k_cache = k
+            cache.v_cache = v
+
+    def _release(self, sequence: Sequence):
+        if sequence.slot is not None:
+            self.pool.release(sequence.slot)
+            sequence.slot = None
+
+    def _loop(self):
+        while True:
+            with self._wakeup:
+                while not self._active and not self._pending:
+                    self._wakeup.wait()
+                admitted = []
+                while self._pending:
+                    slot = self.pool.acquire()
+                    if slot is None:
+                        if not self._pending[0].deferred:
+                            self._pending[0].deferred = True
+                            self.pool.defer()
+                        break
+                    sequence = self._pending.popleft()
+                    sequence.slot = slot
+                    sequence.admitted_at = time.perf_counter()
+                    self._active.append(sequence)
+                    admitted.append(sequence)
+
+            for sequence in admitted:
+                self._prefill(sequence)
+            for sequence in list(self._active):
+                if sequence not in admitted:
+                    self._step(sequence)
+            self.steps += 1
+
+    def _prefill(self, sequence: Sequence):
+        """Start the sequence and produce its first chunk right away."""
+        if sequence.cancelled:
+            self._finish(sequence)
+            return
+        try:
+            with self._lock:
+                self._bind(self.pool.buffers(sequence.slot))
+                call = getattr(self.model, sequence.task)
+                result = call(sequence.image, stream=True, **sequence.kwargs)
+                sequence.tokens = iter(result[STREAM_KEYS[sequence.task]])
+        except Exception as e:
+            self._finish(sequence, e)
+            return
+        self._step(sequence)
+
+    def _step(self, sequence: Sequence):
+        if sequence.cancelled:
+            self._finish(sequence)
+            return
+        try:
+            with self._lock:
+                self._bind(self.pool.buffers(sequence.slot))
+                token = next(sequence.tokens)
+        except StopIteration:
+            self._finish(sequence)
+            return
+        except Exception as e:
+            self._finish(sequence, e)
+            return
+        sequence._append(token)
+        # Image positions plus one per chunk: a lower bound, as the prompt
+        # template and multi-token chunks are not visible from here.
+        self.pool.record(
+            sequence.slot, getattr(sequence.image, "pos", 0) + len(sequence.chunks)
+        )
+
+    def _finish(self, sequence: Sequence, error: Optional[BaseException] = None):
+        if sequence.tokens is not None:
+            with self._lock:
+                sequence.tokens.close()
+        with self._wakeup:
+            if sequence in self._active:
+                self._active.remove(sequence)
+        self._release(sequence)
+        self.completed += 1
+        sequence._close(error)
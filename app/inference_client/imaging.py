@@ -0,0 +1,183 @@
+import io
+import logging
+import math
+import time
+
+from typing import Tuple
+
+from PIL import Image
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # pyvips is optional here; without libvips we fall back to PIL draft mode.
+    pyvips = None
+
+logger = logging.getLogger("moondream2")
+
+# Moondream's crop layout: 378px crops overlapping by 4 patches of 14px, so
+# each crop adds a 266px window and the tiled image keeps a 112px margin.
+CROP_WINDOW = 266
+CROP_MARGIN = 112
+MAX_CROPS = 12
+REDUCE_MODES = ("L", "LA", "RGB", "RGBA", "CMYK", "YCbCr", "I", "F")
+
+
+def select_tiling(height: int, width: int) -> Tuple[int, int]:
+    """Crop grid (rows, columns) Moondream picks for an image of this size.
+
+    Mirrors ``select_tiling`` in the model's ``image_crops`` module.
+    """
+    height, width = height - CROP_MARGIN, width - CROP_MARGIN
+    if height <= CROP_WINDOW or width <= CROP_WINDOW:
+        return 1, 1
+    min_h = math.ceil(height / CROP_WINDOW)
+    min_w = math.ceil(width / CROP_WINDOW)
+    if min_h * min_w > MAX_CROPS:
+        ratio = math.sqrt(MAX_CROPS / (min_h * min_w))
+        return max(1, math.floor(min_h * ratio)), max(1, math.floor(min_w * ratio))
+    h_tiles = max(math.floor(math.sqrt(MAX_CROPS * height / width)), min_h)
+    w_tiles = max(math.floor(math.sqrt(MAX_CROPS * width / height)), min_w)
+    if h_tiles * w_tiles > MAX_CROPS:
+        if w_tiles > h_tiles:
+            w_tiles = MAX_CROPS // h_tiles
+        else:
+            h_tiles = MAX_CROPS // w_tiles
+    return max(1, h_tiles), max(1, w_tiles)
+
+
+def _tiled_size(size: Tuple[int, int]) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """Return the tiling of ``size`` and the (width, height) it resamples to."""
+    rows, columns = select_tiling(size[1], size[0])
+    return (rows, columns), (
+        columns * CROP_WINDOW + CROP_MARGIN,
+        rows * CROP_WINDOW + CROP_MARGIN,
+    )
+
+
+def decode_size(source_size: Tuple[int, int]) -> Tuple[int, int]:
+    """Smallest size to decode ``source_size`` to without changing the result.
+
+    The decoded image keeps the aspect ratio, covers the size the model's
+    tiling resamples the original to, and tiles exactly like the original,
+    so the model sees the same crops either way. Returns ``source_size`` when
+    no smaller size qualifies.
+    """
+    width, height = source_size
+    tiling, (target_w, target_h) = _tiled_size(source_size)
+    scale = max(target_w / width, target_h / height)
+    while scale < 1:
+        size = (math.ceil(width * scale), math.ceil(height * scale))
+        if _tiled_size(size)[0] == tiling:
+            return size
+        # Shrinking changed the tiling; try a little less.
+        scale *= 1.1
+    return source_size
+
+
+def _bitmap_bytes(image: Image.Image) -> int:
+    """Memory PIL allocates for ``image``'s pixels.
+
+    PIL stores 1- and 8-bit modes in one byte per pixel, 16-bit modes in two
+    and everything else, RGB included, in four.
+    """
+    if image.mode in ("1", "L", "P"):
+        pixel = 1
+    elif image.mode.startswith("I;16"):
+        pixel = 2
+    else:
+        pixel = 4
+    return image.width * image.height * pixel
+
+
+def _decode_vips(data, size: Tuple[int, int]) -> tuple:
+    """Shrink-on-load decode through libvips.
+
+    Returns the image and the bytes of the bitmaps allocated for it: the
+    decoded buffer and its PIL copy. libvips streams the shrink itself.
+    """
+    image = pyvips.Image.thumbnail_buffer(
+        data, size[0], height=size[1], size="force", no_rotate=True
+    )
+    if image.interpretation not in ("srgb", "b-w"):
+        image = image.colourspace("srgb")
+    if image.bands in (1, 2):
+        image = image[0].bandjoin([image[0], image[0]])
+    elif image.bands > 3:
+        image = image[:3]
+    if image.format != "uchar":
+        image = image.cast("uchar")
+    pixels = image.write_to_memory()
+    pil_image = Image.frombuffer(
+        "RGB", (image.width, image.height), pixels, "raw", "RGB", 0, 1
+    )
+    return pil_image, len(pixels) + _bitmap_bytes(pil_image)
+
+
+def _decode_pil(image: Image.Image, size: Tuple[int, int]) -> tuple:
+    """Decode through PIL: JPEG draft mode and integer reduction, then an exact
+    resize, so the result matches the libvips path pixel size for size.
+
+    Returns the image and the most bitmap memory held at once, which is at
+    each step the step's input and output together.
+    """
+    # draft() only ever picks a scale that keeps the image >= the requested size.
+    image.draft("RGB", size)
+    image.load()
+    peak = _bitmap_bytes(image)
+
+    def step(source: Image.Image, result: Image.Image) -> Image.Image:
+        nonlocal peak
+        peak = max(peak, _bitmap_bytes(source) + _bitmap_bytes(result))
+        return result
+
+    factor = min(image.width // size[0], image.height // size[1])
+    if factor >= 2:
+        # reduce() only handles 8-bit and 32-bit modes; palette, bilevel and
+        # 16-bit images are converted first.
+        if image.mode not in REDUCE_MODES:
+            image = step(image, image.convert("RGB"))
+        image = step(image, image.reduce(factor))
+    image = step(image, image.convert("RGB"))
+    if image.size != size:
+        image = step(image, image.resize(size, Image.Resampling.LANCZOS))
+    return image, peak
+
+
+def decode_image(data, shrink: bool = True) -> Image.Image:
+    """Decode encoded image bytes to an RGB image no larger than needed.
+
+    With ``shrink``, the image is scaled down during decode to
+    ``decode_size``, leaving the final resize to the model; otherwise it is
+    decoded at native resolution. Both backends return the same size. Decode
+    time and peak memory, the encoded bytes plus the most bitmap memory the
+    decode held at once, are logged and stored in ``image.info``.
+    """
+    start = time.perf_counter()
+    source = Image.open(io.BytesIO(data))
+    source_size = source.size
+    size = decode_size(source_size) if shrink else source_size
+    image = None
+    if size != source_size and pyvips is not None:
+        try:
+            image, bitmap_bytes = _decode_vips(data, size)
+        except pyvips.Error as e:
+            logger.debug(f"libvips decode failed, falling back to PIL: {e}")
+    if image is None:
+        if size != source_size:
+            image, bitmap_bytes = _decode_pil(source, size)
+        else:
+            source.load()
+            image = source.convert("RGB")
+            bitmap_bytes = _bitmap_bytes(source) + _bitmap_bytes(image)
+    decode_ms = (time.perf_counter() - start) * 1000
+    peak_bytes = len(data) + bitmap_bytes
+
+    image.info["decode_ms"] = decode_ms
+    image.info["decode_peak_bytes"] = peak_bytes
+    logger.info(
+        f"Decoded image {source_size[0]}x{source_size[1]} -> "
+        f"{image.width}x{image.height} in {decode_ms:.2f} ms "
+        f"(peak {peak_bytes / (1 << 20):.1f} MB)"
+    )
+    return image
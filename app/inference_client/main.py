@@ -1,16 +1,42 @@
-import io
 import time
 import warnings
 import logging
+import os
 import json
-import base64
+import asyncio
+
+from typing import AsyncIterator, List, Optional, Tuple
 
 from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException, Depends
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from PIL import Image
-from model_service import ModelService
+from model_service import (
+    DEFAULT_COMPILE_CACHE,
+    PRECISIONS,
+    STREAM_KEYS,
+    ModelService,
+)
+from preprocess import DecodePool
+from replicas import start_replicas
+from cpu_config import apply_process_layout, plan_layout
+from caches import ResponseCache, image_digest, is_deterministic
+from scheduler import (
+    PRIORITIES,
+    BatchScheduler,
+    DeadlineExceeded,
+    LocalWorker,
+    QueueFullError,
+)
+from metrics import (
+    DEADLINES_MISSED,
+    REGISTRY,
+    REQUESTS,
+    REQUEST_SECONDS,
+    Gauge,
+    StageTimings,
+)
+from warmup import warmup
 from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.background import BackgroundTask
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
@@ -21,16 +47,212 @@ logging.basicConfig(level=logging.INFO, format="%(message)s")
 logging.getLogger("uvicorn").setLevel(logging.ERROR)
 logging.getLogger("pyvips").setLevel(logging.ERROR)
 
+# Bulk endpoints yield to interactive traffic unless the client says otherwise.
+DEFAULT_PRIORITIES = {"/v1/batch": "low"}
+
+# Static framing of streamed chunk events, around the JSON-encoded text.
+SSE_CHUNK_START = 'data: {"chunk": '
+SSE_EVENT_END = "}\n\n"
+
 VERSION = "v0.0.2"
 
 
-async def lifespan(app: FastAPI):
+def load_model(app: FastAPI):
+    """Load the model and start its workers, forking replicas if configured.
+
+    ``main`` calls this before uvicorn starts the event loop, so replicas fork
+    from a process with no event loop, decode pool or torch thread pool
+    running whose locks they could inherit.
+    """
     model_name = "vikhyatk/moondream2"
     revision = getattr(app.state, "revision", None)
-    app.state.model_service = ModelService(model_name, revision)
+    replicas = getattr(app.state, "replicas", 1)
+    if replicas > 1 and ModelService._get_best_device() != "cpu":
+        logger.warning("Model replicas are CPU only; running a single model.")
+        replicas = 1
+    app.state.cpu_layout = plan_layout(
+        replicas,
+        reserved_cores=getattr(app.state, "reserved_cores", None),
+        intra_op_threads=getattr(app.state, "intra_op_threads", None),
+        inter_op_threads=getattr(app.state, "inter_op_threads", None),
+        pin=getattr(app.state, "cpu_pinning", True),
+    )
+    apply_process_layout(app.state.cpu_layout)
+    compile = getattr(app.state, "compile", False)
+    compile_cache_dir = getattr(app.state, "compile_cache_dir", DEFAULT_COMPILE_CACHE)
+    app.state.model_service = ModelService(
+        model_name,
+        revision,
+        embedding_cache_bytes=getattr(app.state, "embedding_cache_mb", 512) << 20,
+        precision=getattr(app.state, "precision", "fp32"),
+        # Compiling runs the model, so with replicas each one compiles itself
+        # after the fork instead.
+        compile=compile and replicas == 1,
+        compile_cache_dir=compile_cache_dir,
+        max_sequences=getattr(app.state, "max_sequences", 0),
+        kv_pool_bytes=getattr(app.state, "kv_pool_mb", 2048) << 20,
+        prefix_cache_bytes=getattr(app.state, "prefix_cache_mb", 128) << 20,
+        tokenizer_cache_size=getattr(app.state, "tokenizer_cache_size", 4096),
+    )
     logger.info("Model initialized successfully.")
+    plans = app.state.cpu_layout.replicas
+    if replicas > 1:
+        app.state.workers = start_replicas(
+            app.state.model_service,
+            plans,
+            compile_cache_dir=compile_cache_dir if compile else None,
+        )
+    else:
+        app.state.workers = [LocalWorker(app.state.model_service, plan=plans[0])]
+
+
+async def lifespan(app: FastAPI):
+    if getattr(app.state, "workers", None) is None:
+        load_model(app)
+    app.state.scheduler = BatchScheduler(
+        app.state.model_service,
+        workers=app.state.workers,
+        max_batch_size=getattr(app.state, "max_batch_size", 8),
+        max_wait_ms=getattr(app.state, "batch_wait_ms", 5),
+        max_queue_size=getattr(app.state, "max_queue_size", 64),
+        low_priority_share=getattr(app.state, "low_priority_share", 0.2),
+        max_low_priority_wait_ms=getattr(app.state, "low_priority_max_wait_ms", 2000),
+    )
+    await app.state.scheduler.start()
+    app.state.decode_pool = DecodePool(
+        mode=getattr(app.state, "decode_mode", "thread"),
+        workers=getattr(app.state, "decode_workers", min(4, os.cpu_count() or 1)),
+        cpus=app.state.cpu_layout.aux_cpus,
+    )
+    app.state.response_cache = ResponseCache(
+        max_entries=getattr(app.state, "response_cache_size", 1024),
+        ttl_s=getattr(app.state, "response_cache_ttl", 3600),
+    )
+    app.state.stream_flush = (
+        getattr(app.state, "stream_flush_ms", 25),
+        getattr(app.state, "stream_flush_tokens", 8),
+    )
+    register_state_metrics(app)
+    app.state.ready = False
+    app.state.warmup_s = None
+    warmup_task = asyncio.create_task(
+        run_warmup(app, getattr(app.state, "warmup_rounds", 1))
+    )
     logger.info("Moondream Server startup complete.")
     yield
+    warmup_task.cancel()
+    await app.state.scheduler.stop()
+    app.state.decode_pool.shutdown()
+
+
+def register_state_metrics(app: FastAPI):
+    """Register gauges that read scheduler and cache state at scrape time."""
+    state = app.state
+
+    REGISTRY.register(
+        Gauge(
+            "moondream_queue_depth",
+            "Jobs waiting in the scheduler queue.",
+            func=lambda: state.scheduler.depth,
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "moondream_in_flight",
+            "Jobs currently running on each model worker.",
+            ("worker",),
+            func=lambda: {
+                (worker.name,): worker.in_flight for worker in state.scheduler.workers
+            },
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "moondream_queue_rejected_total",
+            "Requests rejected because the queue was full.",
+            func=lambda: state.scheduler.rejected,
+            kind="counter",
+        )
+    )
+
+    def kv_pool(key: str):
+        # Replicas keep their pools in their own processes.
+        engine = state.model_service.engine
+        if engine is None or not isinstance(state.scheduler.workers[0], LocalWorker):
+            return None
+        return engine.pool.snapshot()[key]
+
+    for name, key, kind, help in (
+        ("slots", "slots", "gauge", "Key/value pool slots, one per sequence."),
+        ("in_use", "in_use", "gauge", "Key/value pool slots held by sequences."),
+        ("bytes", "allocated_bytes", "gauge", "Memory preallocated for the pool."),
+        ("occupancy_ratio", "occupancy", "gauge", "Share of pool slots in use."),
+        (
+            "fragmentation_ratio",
+            "fragmentation",
+            "gauge",
+            "Share of positions reserved by in-use slots that are not filled.",
+        ),
+        (
+            "deferred_total",
+            "deferred",
+            "counter",
+            "Sequence admissions deferred because every slot was in use.",
+        ),
+    ):
+        REGISTRY.register(
+            Gauge(
+                f"moondream_kv_pool_{name}",
+                help,
+                func=lambda key=key: kv_pool(key),
+                kind=kind,
+            )
+        )
+
+    model_caches = {"at": 0.0, "snapshots": {}}
+
+    def model_cache(name: str) -> dict:
+        # One round trip to the replicas per scrape rather than one per gauge.
+        now = time.monotonic()
+        if now - model_caches["at"] > 1.0:
+            model_caches["snapshots"] = state.scheduler.cache_snapshots()
+            model_caches["at"] = now
+        return model_caches["snapshots"][name]
+
+    caches = {
+        "embedding": lambda: model_cache("embedding"),
+        "prefix": lambda: model_cache("prefix"),
+        "tokenizer": lambda: model_cache("tokenizer"),
+        "response": lambda: state.response_cache.snapshot(),
+    }
+    for cache, snapshot in caches.items():
+        for name, key, kind, help in (
+            ("hits_total", "hits", "counter", "Cache hits."),
+            ("misses_total", "misses", "counter", "Cache misses."),
+            ("hit_ratio", "hit_ratio", "gauge", "Cache hit ratio since startup."),
+            ("entries", "entries", "gauge", "Entries currently cached."),
+        ):
+            REGISTRY.register(
+                Gauge(
+                    f"moondream_{cache}_cache_{name}",
+                    help,
+                    func=lambda snapshot=snapshot, key=key: snapshot()[key],
+                    kind=kind,
+                )
+            )
+
+
+async def run_warmup(app: FastAPI, rounds: int):
+    """Warm the model in the background, then mark the server ready."""
+    if rounds > 0:
+        try:
+            app.state.warmup_s = await warmup(app.state.scheduler, rounds)
+            logger.info(f"Warmup complete in {app.state.warmup_s:.2f} s")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Warmup failed, serving without it: {e}")
+    app.state.ready = True
 
 
 app = FastAPI(
@@ -45,22 +267,43 @@ class MiddlewareLogging(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         start_time = time.time()
         logger.info(f"New request: {request.url.path}")
+        request.state.timings = StageTimings()
         response = await call_next(request)
+        response.headers["Server-Timing"] = request.state.timings.header()
+        # Unmatched paths share one label to keep metric cardinality bounded.
+        endpoint = request.url.path if "endpoint" in request.scope else "unmatched"
+
+        if not hasattr(response, "body_iterator"):
+            elapsed_ms = (time.time() - start_time) * 1000
+            logger.info(f"Completed {request.url.path} in {elapsed_ms:.2f} ms")
+            REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+            REQUEST_SECONDS.observe(elapsed_ms / 1000, endpoint=endpoint)
+            return response
+
+        # call_next hands every body back as a stream, so measure when the
+        # last chunk has gone out rather than when the headers do.
+        body = response.body_iterator
 
-        if isinstance(response, StreamingResponse):
-            # Attach a background task to log the total streaming time after the response is finished.
-            def log_stream_time():
+        async def timed_body():
+            first_ms = None
+            chunks = 0
+            try:
+                async for chunk in body:
+                    if first_ms is None:
+                        first_ms = (time.time() - start_time) * 1000
+                    chunks += 1
+                    yield chunk
+            finally:
                 elapsed_ms = (time.time() - start_time) * 1000
+                first = f" (first chunk after {first_ms:.2f} ms)" if chunks > 1 else ""
                 logger.info(
-                    f"Completed streaming {request.url.path} in {elapsed_ms:.2f} ms"
+                    f"Completed {request.url.path} in {elapsed_ms:.2f} ms{first}"
                 )
+                REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+                REQUEST_SECONDS.observe(elapsed_ms / 1000, endpoint=endpoint)
 
-            response.background = BackgroundTask(log_stream_time)
-            return response
-        else:
-            elapsed_ms = (time.time() - start_time) * 1000
-            logger.info(f"Completed {request.url.path} in {elapsed_ms:.2f} ms")
-            return response
+        response.body_iterator = timed_body()
+        return response
 
 
 app.add_middleware(MiddlewareLogging)
@@ -74,12 +317,29 @@ def get_model_service(request: Request) -> ModelService:
     return model_service
 
 
-def load_image(file: UploadFile) -> Image.Image:
+def get_scheduler(request: Request) -> BatchScheduler:
+    """Retrieve the batch scheduler instance stored in app.state."""
+    scheduler = getattr(request.app.state, "scheduler", None)
+    if not scheduler:
+        raise HTTPException(status_code=500, detail="Scheduler not initialized")
+    return scheduler
+
+
+def get_response_cache(request: Request) -> ResponseCache:
+    """Retrieve the response cache instance stored in app.state."""
+    return request.app.state.response_cache
+
+
+def get_decode_pool(request: Request) -> DecodePool:
+    """Retrieve the image decode pool stored in app.state."""
+    return request.app.state.decode_pool
+
+
+async def load_image(file: UploadFile, decode_pool: DecodePool) -> Image.Image:
     """Reads an uploaded file and converts it into a PIL Image."""
     try:
         contents = file.file.read()
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
-        return image
+        return await decode_pool.decode(contents)
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=400, detail=f"Error reading image: {str(e)}")
@@ -87,42 +347,333 @@ def load_image(file: UploadFile) -> Image.Image:
         file.file.close()
 
 
-def load_base64_image(image_url: str) -> Image.Image:
+async def load_base64_image(image_url: str, decode_pool: DecodePool) -> Image.Image:
     """Decodes a base64-encoded image and returns a PIL image."""
     if image_url.startswith("data:image"):
         _, encoded = image_url.split(",", 1)
     else:
         encoded = image_url
     try:
-        raw_bytes = base64.b64decode(encoded)
-        image = Image.open(io.BytesIO(raw_bytes)).convert("RGB")
-        return image
+        return await decode_pool.decode(encoded, is_base64=True)
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=400, detail=f"Invalid base64 image data: {e}")
 
 
-def sse_event_generator(raw_generator):
-    for token in raw_generator:
-        yield f"data: {json.dumps({'chunk': token})}\n\n"
-    yield f"data: {json.dumps({'completed': True})}\n\n"
+def is_raw_image(content_type: str) -> bool:
+    """Whether the request body is the image itself rather than JSON or a form."""
+    content_type = content_type.lower()
+    return content_type.startswith("application/octet-stream") or (
+        content_type.startswith("image/")
+    )
+
+
+def raw_param(request: Request, name: str, default: Optional[str] = None):
+    """Task parameter of a raw image upload.
 
+    Read from the query string, or from an ``X-Moondream-<Name>`` header.
+    """
+    value = request.query_params.get(name)
+    if value is None:
+        value = request.headers.get(f"x-moondream-{name}")
+    return default if value is None else value
 
-def process_inference(image: Image.Image, inference_func, **kwargs) -> dict:
-    """Applies the given inference function to a PIL image."""
+
+def raw_settings(request: Request) -> dict:
+    """JSON-encoded ``settings`` parameter of a raw image upload."""
+    value = raw_param(request, "settings")
+    if not value:
+        return {}
     try:
-        return inference_func(image, **kwargs)
+        settings = json.loads(value)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid 'settings' JSON: {e}")
+    if not isinstance(settings, dict):
+        raise HTTPException(status_code=400, detail="'settings' must be a JSON object.")
+    return settings
+
+
+def raw_stream(request: Request) -> bool:
+    return raw_param(request, "stream", "false").lower() in ("1", "true", "yes")
+
+
+async def load_raw_image(request: Request, decode_pool: DecodePool) -> Image.Image:
+    """Decodes an image sent as the raw request body.
+
+    Body chunks are joined once into the buffer the decoder reads.
+    """
+    chunks = []
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                chunks.append(chunk)
+        return await decode_pool.decode(b"".join(chunks))
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=400, detail=f"Error reading image: {str(e)}")
+
+
+def request_deadline(request: Request, settings: Optional[dict] = None):
+    """Absolute ``time.perf_counter()`` deadline of a request, if it has one.
+
+    Given in milliseconds from arrival, as ``deadline_ms`` in ``settings`` or
+    as an ``X-Deadline-Ms`` header. The settings field is removed so it never
+    reaches the model or the response cache key.
+    """
+    value = settings.pop("deadline_ms", None) if settings else None
+    if value is None:
+        value = request.headers.get("x-deadline-ms")
+    if value is None:
+        return None
+    try:
+        ms = float(value)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="'deadline_ms' must be a number.")
+    if ms <= 0:
+        raise HTTPException(status_code=400, detail="'deadline_ms' must be positive.")
+    return request.state.timings.start + ms / 1000
+
+
+def request_priority(request: Request, body: Optional[dict] = None) -> str:
+    """Scheduling priority of a request, ``"high"`` or ``"low"``.
+
+    Read from a ``priority`` field of the JSON body, else a ``priority`` query
+    parameter or ``X-Moondream-Priority`` header, else the endpoint default.
+    """
+    value = body.get("priority") if body else None
+    if value is None:
+        value = raw_param(request, "priority")
+    if value is None:
+        return DEFAULT_PRIORITIES.get(request.url.path, "high")
+    if value not in PRIORITIES:
+        raise HTTPException(
+            status_code=400, detail="'priority' must be 'high' or 'low'."
+        )
+    return value
+
+
+def deadline_exception(detail: str) -> HTTPException:
+    return HTTPException(status_code=504, detail=detail)
+
+
+def check_deadline(scheduler: BatchScheduler, task: str, deadline: Optional[float]):
+    """Rejects a request the current backlog would keep from starting in time."""
+    if deadline is None:
+        return
+    if time.perf_counter() + scheduler.estimated_wait_s() >= deadline:
+        DEADLINES_MISSED.inc(task=task, stage="admission")
+        raise deadline_exception(
+            "Deadline cannot be met with the current inference queue"
+        )
+
+
+async def coalesce_tokens(
+    tokens, flush_ms: float, flush_tokens: int
+) -> AsyncIterator[str]:
+    """Join streamed tokens into chunks, to cut per-token encoding and writes.
+
+    The first token is passed on at once so time to first token does not
+    change. After that a chunk is flushed once it holds ``flush_tokens``
+    tokens or ``flush_ms`` has passed since the previous flush, whichever
+    comes first. ``flush_ms`` of 0 passes every token through.
+    """
+    iterator = tokens.__aiter__()
+    if flush_ms <= 0 or flush_tokens <= 1:
+        async for token in iterator:
+            yield token
+        return
+    loop = asyncio.get_running_loop()
+    pending: List[str] = []
+    flushed_at = None
+    next_token = None
+    try:
+        while True:
+            if next_token is None:
+                next_token = asyncio.ensure_future(iterator.__anext__())
+            timeout = None
+            if pending:
+                timeout = max(0.0, flushed_at + flush_ms / 1000 - loop.time())
+            done, _ = await asyncio.wait((next_token,), timeout=timeout)
+            if done:
+                task, next_token = next_token, None
+                try:
+                    pending.append(task.result())
+                except StopAsyncIteration:
+                    break
+                if flushed_at is not None and len(pending) < flush_tokens:
+                    continue
+            chunk = "".join(pending)
+            pending.clear()
+            flushed_at = loop.time()
+            yield chunk
+        if pending:
+            yield "".join(pending)
+    finally:
+        # The consumer stopped early: stop waiting on the token stream so it
+        # sees the cancellation and ends generation.
+        if next_token is not None:
+            next_token.cancel()
+
+
+async def sse_event_generator(
+    raw_generator,
+    timings: Optional[StageTimings] = None,
+    flush: Tuple[float, int] = (0, 1),
+):
+    """Formats a token stream as SSE, coalescing tokens per ``flush``.
+
+    ``flush`` is ``(flush_ms, flush_tokens)``, see ``coalesce_tokens``.
+    """
+    chunks = coalesce_tokens(raw_generator, *flush)
+    try:
+        async for chunk in chunks:
+            yield SSE_CHUNK_START + json.dumps(chunk) + SSE_EVENT_END
+    finally:
+        await chunks.aclose()
+    if timings is not None:
+        yield f"data: {json.dumps({'timings': timings.as_dict()})}\n\n"
+    completed = {"completed": True}
+    if getattr(raw_generator, "truncated", False):
+        completed["truncated"] = True
+    yield f"data: {json.dumps(completed)}\n\n"
+
+
+def record_image_timings(timings: Optional[StageTimings], image):
+    """Adds the upload's base64 and image decode durations to ``timings``,
+    and the decode's peak memory as a note."""
+    if timings is None or not isinstance(image, Image.Image):
+        return
+    for stage, key in (("b64", "b64_ms"), ("decode", "decode_ms")):
+        if key in image.info:
+            timings.add(stage, image.info[key])
+    if "decode_peak_bytes" in image.info:
+        peak_mb = image.info["decode_peak_bytes"] / (1 << 20)
+        timings.note("decode_peak", f"{peak_mb:.1f} MB")
+
+
+def json_response(request: Request, content: dict) -> JSONResponse:
+    """Builds a JSON response, timing serialization for Server-Timing."""
+    start = time.perf_counter()
+    response = JSONResponse(content)
+    request.state.timings.add("serialize", (time.perf_counter() - start) * 1000)
+    return response
+
+
+def queue_full_exception(e: QueueFullError) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+async def process_inference(
+    scheduler: BatchScheduler,
+    response_cache: ResponseCache,
+    task: str,
+    image: Image.Image,
+    image_hash: Optional[str] = None,
+    block: bool = False,
+    timings: Optional[StageTimings] = None,
+    deadline: Optional[float] = None,
+    priority: str = "high",
+    **kwargs,
+) -> dict:
+    """Runs a task on a PIL image through the batch scheduler.
+
+    Deterministic requests are answered from the response cache when possible.
+    ``image_hash`` must be given when ``image`` is an already encoded image.
+    ``block`` waits for queue space instead of failing with 503.
+    ``timings`` collects the request's stage durations.
+    With a ``deadline``, captions and queries are cut short when it passes
+    and returned with ``truncated`` set; other tasks fail with 504 if they
+    cannot start in time. ``priority`` is the scheduling class, "high" or "low".
+    """
+    record_image_timings(timings, image)
+    key = None
+    if is_deterministic(task, kwargs.get("settings")):
+        key = ResponseCache.make_key(
+            image_hash or image_digest(image),
+            task,
+            kwargs,
+            f"{scheduler.model_service.revision}:{scheduler.model_service.precision}",
+        )
+        cached = response_cache.get(key)
+        if cached is not None:
+            if timings is not None:
+                timings.note("cache", "hit")
+            return cached
+    check_deadline(scheduler, task, deadline)
+    stages = timings.stages if timings is not None else None
+    try:
+        if deadline is not None and task in STREAM_KEYS:
+            # Generate token by token so a partial answer survives the deadline.
+            tokens = scheduler.stream(
+                task,
+                image,
+                timings=stages,
+                deadline=deadline,
+                priority=priority,
+                **kwargs,
+            )
+            text = "".join([token async for token in tokens])
+            result = {STREAM_KEYS[task]: text}
+            if tokens.truncated:
+                result["truncated"] = True
+                return result
+        else:
+            result = await scheduler.submit(
+                task,
+                image,
+                block=block,
+                timings=stages,
+                deadline=deadline,
+                priority=priority,
+                **kwargs,
+            )
+        if key is not None:
+            response_cache.put(key, result)
+        return result
+    except QueueFullError as e:
+        raise queue_full_exception(e)
+    except DeadlineExceeded as e:
+        raise deadline_exception(str(e))
     except Exception as e:
         logger.error(f"Inference error: {e}")
         raise HTTPException(status_code=500, detail=f"Inference error: {str(e)}")
 
 
-def process_inference_stream(key: str, image: Image.Image, inference_func, **kwargs):
-    """Applies the given inference function to a PIL image in streaming mode."""
+def process_inference_stream(
+    scheduler: BatchScheduler,
+    task: str,
+    image: Image.Image,
+    timings: Optional[StageTimings] = None,
+    deadline: Optional[float] = None,
+    priority: str = "high",
+    flush: Tuple[float, int] = (0, 1),
+    **kwargs,
+):
+    """Queues a streaming task on a PIL image and returns its SSE generator.
+
+    With ``timings`` the stream ends with a ``timings`` event. Generation
+    stops at ``deadline``, marking the ``completed`` event as truncated.
+    ``priority`` is the scheduling class, "high" or "low". ``flush`` sets how
+    tokens are coalesced into events, see ``coalesce_tokens``.
+    """
+    record_image_timings(timings, image)
+    check_deadline(scheduler, task, deadline)
     try:
-        result = inference_func(image, **kwargs)
-        raw_generator = result[key]
-        return sse_event_generator(raw_generator)
+        raw_generator = scheduler.stream(
+            task,
+            image,
+            timings=timings.stages if timings is not None else None,
+            deadline=deadline,
+            priority=priority,
+            **kwargs,
+        )
+        return sse_event_generator(raw_generator, timings, flush)
+    except QueueFullError as e:
+        raise queue_full_exception(e)
     except Exception as e:
         logger.error(f"Inference error (streaming): {e}")
         raise HTTPException(
@@ -136,6 +687,9 @@ async def caption_endpoint(
     length: str = Form(None, description="Caption length: 'short' or 'normal'"),
     init_image: UploadFile = File(None, description="Input image file"),
     model_service: ModelService = Depends(get_model_service),
+    scheduler: BatchScheduler = Depends(get_scheduler),
+    response_cache: ResponseCache = Depends(get_response_cache),
+    decode_pool: DecodePool = Depends(get_decode_pool),
 ):
     content_type = request.headers.get("content-type", "")
 
@@ -145,9 +699,16 @@ async def caption_endpoint(
         length = body.get("length", "normal")
         stream = body.get("stream", False)
         settings = body.get("settings", {})
+        priority = request_priority(request, body)
         if not image_url:
             raise HTTPException(status_code=400, detail="Missing 'image_url' in JSON.")
-        image = load_base64_image(image_url)
+        image = await load_base64_image(image_url, decode_pool)
+    elif is_raw_image(content_type):
+        length = raw_param(request, "length", "normal")
+        stream = raw_stream(request)
+        settings = raw_settings(request)
+        priority = request_priority(request)
+        image = await load_raw_image(request, decode_pool)
     else:
         if not init_image:
             raise HTTPException(
@@ -159,25 +720,41 @@ async def caption_endpoint(
                 status_code=400,
                 detail="For multipart form-data, 'length' must be provided.",
             )
-        image = load_image(init_image)
+        image = await load_image(init_image, decode_pool)
         stream = False
         settings = {}
+        priority = request_priority(request)
+    deadline = request_deadline(request, settings)
 
     if stream:
         event_generator = process_inference_stream(
+            scheduler,
             "caption",
             image,
-            model_service.caption,
+            timings=request.state.timings,
+            deadline=deadline,
+            priority=priority,
+            flush=request.app.state.stream_flush,
             length=length,
-            stream=True,
             settings=settings,
         )
         return StreamingResponse(event_generator, media_type="text/event-stream")
     else:
-        result = process_inference(
-            image, model_service.caption, length=length, settings=settings
+        result = await process_inference(
+            scheduler,
+            response_cache,
+            "caption",
+            image,
+            timings=request.state.timings,
+            deadline=deadline,
+            priority=priority,
+            length=length,
+            settings=settings,
         )
-        return JSONResponse({"caption": result["caption"], "request_id": 0})
+        content = {"caption": result["caption"], "request_id": 0}
+        if result.get("truncated"):
+            content["truncated"] = True
+        return json_response(request, content)
 
 
 @app.post("/v1/query", summary="Answer a visual query about an image")
@@ -186,6 +763,9 @@ async def query_endpoint(
     question: str = Form(None, description="The visual query question"),
     init_image: UploadFile = File(None, description="Input image file"),
     model_service: ModelService = Depends(get_model_service),
+    scheduler: BatchScheduler = Depends(get_scheduler),
+    response_cache: ResponseCache = Depends(get_response_cache),
+    decode_pool: DecodePool = Depends(get_decode_pool),
 ):
     content_type = request.headers.get("content-type", "")
 
@@ -195,12 +775,24 @@ async def query_endpoint(
         question = body.get("question", "")
         stream = body.get("stream", False)
         settings = body.get("settings", {})
+        priority = request_priority(request, body)
         if not image_url or not question:
             raise HTTPException(
                 status_code=400,
                 detail="Both 'image_url' and 'question' must be present in JSON.",
             )
-        image = load_base64_image(image_url)
+        image = await load_base64_image(image_url, decode_pool)
+    elif is_raw_image(content_type):
+        question = raw_param(request, "question")
+        if not question:
+            raise HTTPException(
+                status_code=400,
+                detail="For raw image uploads, 'question' must be provided.",
+            )
+        stream = raw_stream(request)
+        settings = raw_settings(request)
+        priority = request_priority(request)
+        image = await load_raw_image(request, decode_pool)
     else:
         if not init_image:
             raise HTTPException(
@@ -212,20 +804,41 @@ async def query_endpoint(
                 status_code=400,
                 detail="For multipart/form-data, 'question' must be provided.",
             )
-        image = load_image(init_image)
+        image = await load_image(init_image, decode_pool)
+        stream = False
+        settings = {}
+        priority = request_priority(request)
+    deadline = request_deadline(request, settings)
+
     if stream:
         event_generator = process_inference_stream(
-            "answer",
+            scheduler,
+            "query",
             image,
-            model_service.query,
+            timings=request.state.timings,
+            deadline=deadline,
+            priority=priority,
+            flush=request.app.state.stream_flush,
             question=question,
-            stream=True,
             settings=settings,
         )
         return StreamingResponse(event_generator, media_type="text/event-stream")
     else:
-        result = process_inference(image, model_service.query, question=question)
-        return JSONResponse({"answer": result["answer"], "request_id": 0})
+        result = await process_inference(
+            scheduler,
+            response_cache,
+            "query",
+            image,
+            timings=request.state.timings,
+            deadline=deadline,
+            priority=priority,
+            question=question,
+            settings=settings,
+        )
+        content = {"answer": result["answer"], "request_id": 0}
+        if result.get("truncated"):
+            content["truncated"] = True
+        return json_response(request, content)
 
 
 @app.post("/v1/detect", summary="Detect objects in an image")
@@ -234,6 +847,9 @@ async def detect_endpoint(
     obj: str = Form(None, description="The object to detect (e.g., 'face')"),
     init_image: UploadFile = File(None, description="Input image file"),
     model_service: ModelService = Depends(get_model_service),
+    scheduler: BatchScheduler = Depends(get_scheduler),
+    response_cache: ResponseCache = Depends(get_response_cache),
+    decode_pool: DecodePool = Depends(get_decode_pool),
 ):
     content_type = request.headers.get("content-type", "")
 
@@ -246,10 +862,31 @@ async def detect_endpoint(
                 status_code=400,
                 detail="Both 'image_url' and 'object' must be present in JSON.",
             )
-        image = load_base64_image(image_url)
-        result = process_inference(image, model_service.detect, obj=obj)
+        deadline = request_deadline(request, body.get("settings"))
+        priority = request_priority(request, body)
+        image = await load_base64_image(image_url, decode_pool)
+        result = await process_inference(
+            scheduler,
+            response_cache,
+            "detect",
+            image,
+            timings=request.state.timings,
+            deadline=deadline,
+            priority=priority,
+            obj=obj,
+        )
         obj = result.get("objects", [])
-        return JSONResponse({"objects": obj, "request_id": 0})
+        return json_response(request, {"objects": obj, "request_id": 0})
+    elif is_raw_image(content_type):
+        obj = raw_param(request, "object")
+        if not obj:
+            raise HTTPException(
+                status_code=400,
+                detail="For raw image uploads, 'object' must be provided.",
+            )
+        deadline = request_deadline(request, raw_settings(request))
+        priority = request_priority(request)
+        image = await load_raw_image(request, decode_pool)
     else:
         if not init_image:
             raise HTTPException(
@@ -261,11 +898,22 @@ async def detect_endpoint(
                 status_code=400,
                 detail="For multipart/form-data, 'object' must be provided.",
             )
-        image = load_image(init_image)
+        deadline = request_deadline(request)
+        priority = request_priority(request)
+        image = await load_image(init_image, decode_pool)
 
-    result = process_inference(image, model_service.detect, obj=obj)
+    result = await process_inference(
+        scheduler,
+        response_cache,
+        "detect",
+        image,
+        timings=request.state.timings,
+        deadline=deadline,
+        priority=priority,
+        obj=obj,
+    )
     obj = result.get("objects", [])
-    return JSONResponse({"objects": obj, "request_id": 0})
+    return json_response(request, {"objects": obj, "request_id": 0})
 
 
 @app.post("/v1/point", summary="Find points corresponding to an object in an image")
@@ -274,6 +922,9 @@ async def point_endpoint(
     obj: str = Form(None, description="The object to point at (e.g., 'person')"),
     init_image: UploadFile = File(None, description="Input image file"),
     model_service: ModelService = Depends(get_model_service),
+    scheduler: BatchScheduler = Depends(get_scheduler),
+    response_cache: ResponseCache = Depends(get_response_cache),
+    decode_pool: DecodePool = Depends(get_decode_pool),
 ):
     content_type = request.headers.get("content-type", "")
 
@@ -286,10 +937,31 @@ async def point_endpoint(
                 status_code=400,
                 detail="Both 'image_url' and 'object' must be present in JSON.",
             )
-        image = load_base64_image(image_url)
-        result = process_inference(image, model_service.point, obj=obj)
+        deadline = request_deadline(request, body.get("settings"))
+        priority = request_priority(request, body)
+        image = await load_base64_image(image_url, decode_pool)
+        result = await process_inference(
+            scheduler,
+            response_cache,
+            "point",
+            image,
+            timings=request.state.timings,
+            deadline=deadline,
+            priority=priority,
+            obj=obj,
+        )
         points = result.get("points", [])
-        return JSONResponse({"points": points, "count": len(points)})
+        return json_response(request, {"points": points, "count": len(points)})
+    elif is_raw_image(content_type):
+        obj = raw_param(request, "object")
+        if not obj:
+            raise HTTPException(
+                status_code=400,
+                detail="For raw image uploads, 'object' must be provided.",
+            )
+        deadline = request_deadline(request, raw_settings(request))
+        priority = request_priority(request)
+        image = await load_raw_image(request, decode_pool)
     else:
         if not init_image:
             raise HTTPException(
@@ -301,11 +973,223 @@ async def point_endpoint(
                 status_code=400,
                 detail="For multipart/form-data, 'object' must be provided.",
             )
-        image = load_image(init_image)
+        deadline = request_deadline(request)
+        priority = request_priority(request)
+        image = await load_image(init_image, decode_pool)
 
-    result = process_inference(image, model_service.point, obj=obj)
+    result = await process_inference(
+        scheduler,
+        response_cache,
+        "point",
+        image,
+        timings=request.state.timings,
+        deadline=deadline,
+        priority=priority,
+        obj=obj,
+    )
     points = result.get("points", [])
-    return JSONResponse({"points": points, "count": len(points)})
+    return json_response(request, {"points": points, "count": len(points)})
+
+
+def parse_task_spec(spec: dict, settings: dict) -> tuple:
+    """Turns one entry of a batch_tasks request into (task, kwargs)."""
+    if not isinstance(spec, dict):
+        raise HTTPException(status_code=400, detail="Each task must be an object.")
+    task = spec.get("task")
+    settings = spec.get("settings", settings)
+    if isinstance(settings, dict):
+        # Each task gets its own copy; request_deadline pops from it.
+        settings = dict(settings)
+    if task == "caption":
+        return task, {"length": spec.get("length", "normal"), "settings": settings}
+    if task == "query":
+        if not spec.get("question"):
+            raise HTTPException(
+                status_code=400, detail="Query tasks require a 'question'."
+            )
+        return task, {"question": spec["question"], "settings": settings}
+    if task in ("detect", "point"):
+        if not spec.get("object"):
+            raise HTTPException(
+                status_code=400,
+                detail=f"{task.capitalize()} tasks require an 'object'.",
+            )
+        return task, {"obj": spec["object"], "settings": settings}
+    raise HTTPException(
+        status_code=400,
+        detail=f"Unknown task '{task}'. Tasks are caption, query, detect and point.",
+    )
+
+
+def format_task_result(task: str, result: dict) -> dict:
+    """Shapes a ModelService result like the matching single-task endpoint."""
+    if task == "caption":
+        content = {"caption": result["caption"]}
+    elif task == "query":
+        content = {"answer": result["answer"]}
+    elif task == "detect":
+        return {"objects": result.get("objects", [])}
+    else:
+        points = result.get("points", [])
+        return {"points": points, "count": len(points)}
+    if result.get("truncated"):
+        content["truncated"] = True
+    return content
+
+
+@app.post("/v1/batch_tasks", summary="Run several tasks against one image")
+async def batch_tasks_endpoint(
+    request: Request,
+    scheduler: BatchScheduler = Depends(get_scheduler),
+    response_cache: ResponseCache = Depends(get_response_cache),
+    decode_pool: DecodePool = Depends(get_decode_pool),
+):
+    body = await request.json()
+    image_url = body.get("image_url")
+    specs = body.get("tasks")
+    stream = body.get("stream", False)
+    settings = body.get("settings", {})
+    if not image_url or not isinstance(specs, list) or not specs:
+        raise HTTPException(
+            status_code=400,
+            detail="Both 'image_url' and a non-empty 'tasks' list must be present in JSON.",
+        )
+    tasks = [parse_task_spec(spec, settings) for spec in specs]
+    deadlines = [request_deadline(request, kwargs["settings"]) for _, kwargs in tasks]
+    priority = request_priority(request, body)
+
+    # Decode and encode once; every task then runs against the shared encoding.
+    image = await load_base64_image(image_url, decode_pool)
+    image_hash = image_digest(image)
+    encoded = await process_inference(
+        scheduler, response_cache, "encode", image, priority=priority
+    )
+
+    async def run_task(index: int, task: str, kwargs: dict) -> dict:
+        try:
+            result = await process_inference(
+                scheduler,
+                response_cache,
+                task,
+                encoded,
+                image_hash=image_hash,
+                deadline=deadlines[index],
+                priority=priority,
+                **kwargs,
+            )
+            return {"index": index, "task": task, **format_task_result(task, result)}
+        except HTTPException as e:
+            return {"index": index, "task": task, "error": e.detail}
+
+    # Submitting every task at once lets the scheduler batch them by type.
+    pending = [
+        asyncio.ensure_future(run_task(i, task, kwargs))
+        for i, (task, kwargs) in enumerate(tasks)
+    ]
+
+    if stream:
+
+        async def event_generator():
+            try:
+                for next_result in asyncio.as_completed(pending):
+                    yield f"data: {json.dumps(await next_result)}\n\n"
+                yield f"data: {json.dumps({'completed': True})}\n\n"
+            finally:
+                # The client went away: stop the tasks it will never read.
+                for task in pending:
+                    task.cancel()
+
+        return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+    results = await asyncio.gather(*pending)
+    return JSONResponse({"results": results, "request_id": 0})
+
+
+@app.post("/v1/batch", summary="Run tasks over many images, streamed as NDJSON")
+async def batch_endpoint(
+    request: Request,
+    scheduler: BatchScheduler = Depends(get_scheduler),
+    response_cache: ResponseCache = Depends(get_response_cache),
+    decode_pool: DecodePool = Depends(get_decode_pool),
+):
+    body = await request.json()
+    items = body.get("items")
+    settings = body.get("settings", {})
+    if not isinstance(items, list) or not items:
+        raise HTTPException(
+            status_code=400, detail="A non-empty 'items' list must be present in JSON."
+        )
+    priority = request_priority(request, body)
+    specs = []
+    for item in items:
+        task, kwargs = parse_task_spec(item, settings)
+        if not item.get("image_url"):
+            raise HTTPException(
+                status_code=400, detail="Every item requires an 'image_url'."
+            )
+        deadline = request_deadline(request, kwargs["settings"])
+        specs.append((item.get("id"), item["image_url"], task, deadline, kwargs))
+
+    cores = os.cpu_count() or 1
+    # Keep decoding just far enough ahead of the model to fill its batches.
+    limiter = asyncio.Semaphore(max(cores, scheduler.max_batch_size * 2))
+
+    async def run_item(
+        index: int,
+        item_id,
+        image_url: str,
+        task: str,
+        deadline: Optional[float],
+        kwargs: dict,
+    ):
+        entry = {"index": index, "id": item_id, "task": task}
+        async with limiter:
+            try:
+                image = await load_base64_image(image_url, decode_pool)
+                result = await process_inference(
+                    scheduler,
+                    response_cache,
+                    task,
+                    image,
+                    block=True,
+                    deadline=deadline,
+                    priority=priority,
+                    **kwargs,
+                )
+                entry.update(format_task_result(task, result))
+            except HTTPException as e:
+                entry["error"] = e.detail
+        return entry
+
+    start_time = time.perf_counter()
+    pending = [
+        asyncio.ensure_future(run_item(i, *spec)) for i, spec in enumerate(specs)
+    ]
+
+    async def ndjson_generator():
+        failed = 0
+        try:
+            for next_result in asyncio.as_completed(pending):
+                entry = await next_result
+                failed += "error" in entry
+                yield json.dumps(entry) + "\n"
+        finally:
+            # The client went away: stop the items it will never read.
+            for task in pending:
+                task.cancel()
+        elapsed_s = time.perf_counter() - start_time
+        items_per_s = len(pending) / elapsed_s if elapsed_s else 0.0
+        summary = {
+            "items": len(pending),
+            "failed": failed,
+            "elapsed_s": round(elapsed_s, 3),
+            "items_per_s": round(items_per_s, 3),
+            "cores": cores,
+            "items_per_s_per_core": round(items_per_s / cores, 3),
+        }
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return StreamingResponse(ndjson_generator(), media_type="application/x-ndjson")
 
 
 @app.get("/v1/health", summary="Health check endpoint")
@@ -313,11 +1197,67 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/v1/ready", summary="Readiness check endpoint")
+def ready(request: Request):
+    if not request.app.state.ready:
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    return {"status": "ready", "warmup_s": request.app.state.warmup_s}
+
+
+@app.get("/metrics", summary="Prometheus metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(
+        REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/v1/stats", summary="Scheduler statistics")
+def stats(
+    request: Request,
+    scheduler: BatchScheduler = Depends(get_scheduler),
+    model_service: ModelService = Depends(get_model_service),
+):
+    caches = scheduler.cache_snapshots()
+    return {
+        "batching": scheduler.stats.snapshot(),
+        "queue": scheduler.queue_snapshot(),
+        "embedding_cache": caches.get("embedding"),
+        "prefix_cache": caches.get("prefix"),
+        "tokenizer_cache": caches.get("tokenizer"),
+        # Replicas run their own engines in their own processes.
+        "generation": (
+            model_service.engine.snapshot()
+            if model_service.engine and isinstance(scheduler.workers[0], LocalWorker)
+            else None
+        ),
+        "response_cache": request.app.state.response_cache.snapshot(),
+    }
+
+
+@app.get("/v1/cache", summary="Response cache statistics")
+def cache_stats(response_cache: ResponseCache = Depends(get_response_cache)):
+    return response_cache.snapshot()
+
+
+@app.post("/v1/cache/clear", summary="Drop all cached responses")
+def cache_clear(
+    response_cache: ResponseCache = Depends(get_response_cache),
+    scheduler: BatchScheduler = Depends(get_scheduler),
+):
+    response_cache.clear()
+    scheduler.clear_caches(("prefix",))
+    return {"status": "ok"}
+
+
 @app.get("/v1/version", summary="Health check endpoint")
-def health(model_service: ModelService = Depends(get_model_service)):
+def health(request: Request, model_service: ModelService = Depends(get_model_service)):
     return {
         "inference_server_version": VERSION,
         "model_revision": model_service.revision,
+        "precision": model_service.precision,
+        "compiled": model_service.compiled,
+        "cpu_layout": request.app.state.cpu_layout.to_dict(),
+        "load_timings_ms": model_service.load_timings,
     }
 
 
@@ -332,9 +1272,192 @@ if __name__ == "__main__":
     parser.add_argument(
         "--revision", type=str, default=None, help="Moondream revision to use"
     )
+    parser.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        default="fp32",
+        help="Model weight precision; int8 uses torchao dynamic quantization",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the vision encoder and decode step with torch.compile",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        type=str,
+        default=DEFAULT_COMPILE_CACHE,
+        help="Directory for persistent torch.compile artifacts",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="Number of model replica processes sharing the weights (CPU only)",
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=None,
+        help="Torch intra-op threads per model worker (default: its physical cores)",
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        default=None,
+        help="Torch inter-op threads (default: 1)",
+    )
+    parser.add_argument(
+        "--reserved-cores",
+        type=int,
+        default=None,
+        help="Physical cores kept free of model work for decoding and other "
+        "processes (default: 1 on hosts with 4+ cores)",
+    )
+    parser.add_argument(
+        "--no-cpu-pinning",
+        action="store_true",
+        help="Do not pin model workers and decode threads to core sets",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=8,
+        help="Maximum number of requests grouped into one model batch",
+    )
+    parser.add_argument(
+        "--batch-wait-ms",
+        type=float,
+        default=5,
+        help="How long to wait for more requests before dispatching a batch",
+    )
+    parser.add_argument(
+        "--max-queue-size",
+        type=int,
+        default=64,
+        help="Requests of each priority allowed to wait for the model before returning 503",
+    )
+    parser.add_argument(
+        "--max-sequences",
+        type=int,
+        default=0,
+        help="Captions and queries decoded together per model instance; each "
+        "one holds its own key/value buffers, within --kv-pool-mb. 0 (the "
+        "default) takes as many as the pool fits, up to 4, and decodes one at "
+        "a time when it fits only one; 1 always generates one at a time",
+    )
+    parser.add_argument(
+        "--kv-pool-mb",
+        type=int,
+        default=2048,
+        help="Memory budget for the preallocated key/value pool; caps "
+        "--max-sequences to the slots that fit (about 768 MB each in fp32). "
+        "0 for one slot per sequence, however large",
+    )
+    parser.add_argument(
+        "--prefix-cache-mb",
+        type=int,
+        default=128,
+        help="Memory budget for cached prompt prefill state per image "
+        "(0 to disable)",
+    )
+    parser.add_argument(
+        "--tokenizer-cache-size",
+        type=int,
+        default=4096,
+        help="Maximum number of tokenized prompts to cache (0 to disable)",
+    )
+    parser.add_argument(
+        "--low-priority-share",
+        type=float,
+        default=0.2,
+        help="Share of dequeues given to low-priority (bulk) jobs while "
+        "high-priority jobs are also waiting",
+    )
+    parser.add_argument(
+        "--low-priority-max-wait-ms",
+        type=float,
+        default=2000,
+        help="Queue wait after which a low-priority job is served next",
+    )
+    parser.add_argument(
+        "--embedding-cache-mb",
+        type=int,
+        default=512,
+        help="Memory budget for cached image embeddings (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--response-cache-size",
+        type=int,
+        default=1024,
+        help="Maximum number of cached deterministic responses (0 disables)",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=3600,
+        help="Seconds a cached response stays valid",
+    )
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default=min(4, os.cpu_count() or 1),
+        help="Number of image decode/preprocess workers",
+    )
+    parser.add_argument(
+        "--decode-mode",
+        choices=["thread", "process"],
+        default="thread",
+        help="Run image decoding on a thread pool or a process pool",
+    )
+    parser.add_argument(
+        "--warmup-rounds",
+        type=int,
+        default=1,
+        help="Synthetic warmup rounds before /v1/ready reports ready (0 to skip)",
+    )
+    parser.add_argument(
+        "--stream-flush-ms",
+        type=float,
+        default=25,
+        help="Longest a streamed token waits to be sent with later ones "
+        "(0 sends every token as its own event)",
+    )
+    parser.add_argument(
+        "--stream-flush-tokens",
+        type=int,
+        default=8,
+        help="Tokens that trigger an immediate flush of a streamed event",
+    )
     args = parser.parse_args()
 
     app.state.revision = args.revision
+    app.state.precision = args.precision
+    app.state.compile = args.compile
+    app.state.compile_cache_dir = args.compile_cache_dir
+    app.state.replicas = args.replicas
+    app.state.intra_op_threads = args.intra_op_threads
+    app.state.inter_op_threads = args.inter_op_threads
+    app.state.reserved_cores = args.reserved_cores
+    app.state.cpu_pinning = not args.no_cpu_pinning
+    app.state.max_batch_size = args.max_batch_size
+    app.state.batch_wait_ms = args.batch_wait_ms
+    app.state.max_queue_size = args.max_queue_size
+    app.state.max_sequences = args.max_sequences
+    app.state.kv_pool_mb = args.kv_pool_mb
+    app.state.prefix_cache_mb = args.prefix_cache_mb
+    app.state.tokenizer_cache_size = args.tokenizer_cache_size
+    app.state.low_priority_share = args.low_priority_share
+    app.state.low_priority_max_wait_ms = args.low_priority_max_wait_ms
+    app.state.embedding_cache_mb = args.embedding_cache_mb
+    app.state.response_cache_size = args.response_cache_size
+    app.state.response_cache_ttl = args.response_cache_ttl
+    app.state.decode_workers = args.decode_workers
+    app.state.decode_mode = args.decode_mode
+    app.state.warmup_rounds = args.warmup_rounds
+    app.state.stream_flush_ms = args.stream_flush_ms
+    app.state.stream_flush_tokens = args.stream_flush_tokens
 
+    load_model(app)
     logger.info(f"Starting server on port: {args.port}")
     uvicorn.run(app, host="0.0.0.0", port=args.port, log_level="error")
@@ -0,0 +1,307 @@
+"""
+Minimal Prometheus-style metrics for the inference server.
+
+Counters and histograms are updated in place under a lock; gauges backed by a
+callback are evaluated only when ``/metrics`` is scraped, so queue and cache
+state cost nothing on the request path.
+"""
+
+import math
+import threading
+import time
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = ""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+            for key, v in values
+        ]
+
+
+class Gauge(_Metric):
+    """A gauge set directly, or computed by ``func`` at scrape time.
+
+    ``func`` returns a number, or a dict mapping label value tuples to numbers.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        func: Optional[Callable] = None,
+        kind: str = "gauge",
+    ):
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self.func = func
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        if self.func is not None:
+            try:
+                values = self.func()
+            except Exception:
+                # Not available yet, e.g. scraped before startup finished.
+                return []
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+            for key, v in values.items()
+            if v is not None
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [per-bucket counts..., +Inf count], sum.
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._values.items()
+            ]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} "
+                    f"{cumulative}"
+                )
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+class StageTimings:
+    """Durations of the stages of one request, for the Server-Timing header."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.notes: Dict[str, str] = {}
+
+    def add(self, stage: str, ms: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + ms
+
+    def note(self, name: str, description: str):
+        self.notes[name] = description
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def as_dict(self) -> Dict[str, float]:
+        timings = {stage: round(ms, 2) for stage, ms in self.stages.items()}
+        timings["total"] = round(self.total_ms(), 2)
+        return timings
+
+    def header(self) -> str:
+        entries = [f'{name};desc="{desc}"' for name, desc in self.notes.items()]
+        entries += [f"{stage};dur={ms:.2f}" for stage, ms in self.as_dict().items()]
+        return ", ".join(entries)
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(
+    Counter(
+        "moondream_requests_total",
+        "HTTP requests by endpoint and status code.",
+        ("endpoint", "status"),
+    )
+)
+REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "moondream_request_duration_seconds",
+        "End-to-end request latency, including streaming, by endpoint.",
+        ("endpoint",),
+    )
+)
+QUEUE_WAIT_SECONDS = REGISTRY.register(
+    Histogram(
+        "moondream_queue_wait_seconds",
+        "Time jobs spent queued before reaching a model worker.",
+        ("task", "priority"),
+    )
+)
+BATCH_SIZE = REGISTRY.register(
+    Histogram(
+        "moondream_batch_size",
+        "Number of jobs per dispatched batch.",
+        ("task",),
+        buckets=SIZE_BUCKETS,
+    )
+)
+TIME_TO_FIRST_TOKEN = REGISTRY.register(
+    Histogram(
+        "moondream_time_to_first_token_seconds",
+        "Time from enqueue to the first streamed token.",
+        ("task",),
+    )
+)
+TOKENS = REGISTRY.register(
+    Counter(
+        "moondream_generated_tokens_total",
+        "Tokens generated for caption and query requests.",
+        ("task",),
+    )
+)
+CANCELLED_STREAMS = REGISTRY.register(
+    Counter(
+        "moondream_cancelled_streams_total",
+        "Streamed generations stopped because the client disconnected.",
+        ("task",),
+    )
+)
+CANCELLED_TOKENS = REGISTRY.register(
+    Counter(
+        "moondream_cancelled_tokens_total",
+        "Tokens generated for streams whose client disconnected.",
+        ("task",),
+    )
+)
+DEADLINES_MISSED = REGISTRY.register(
+    Counter(
+        "moondream_deadline_exceeded_total",
+        "Requests whose deadline ran out, by the stage it happened in "
+        "(admission, queue or generation).",
+        ("task", "stage"),
+    )
+)
+TOKENS_PER_SECOND = REGISTRY.register(
+    Histogram(
+        "moondream_stream_tokens_per_second",
+        "Decode throughput of streamed generations after the first token.",
+        ("task",),
+        buckets=RATE_BUCKETS,
+    )
+)
+DECODE_SECONDS = REGISTRY.register(
+    Histogram(
+        "moondream_image_decode_seconds",
+        "Time to decode an uploaded image.",
+    )
+)
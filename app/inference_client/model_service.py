@@ -1,26 +1,334 @@
+import json
+import os
+import threading
+import time
 import torch
+from collections import OrderedDict
+from contextlib import nullcontext
+from huggingface_hub import snapshot_download
+from huggingface_hub.utils import LocalEntryNotFoundError
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from PIL import Image
 import logging
 
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from caches import (
+    EmbeddingCache,
+    PrefixCache,
+    TokenizerCache,
+    image_digest,
+    tensor_nbytes,
+)
+from generation import (
+    STREAM_KEYS,
+    GenerationEngine,
+    image_context,
+    install_prefix_cache,
+)
+
 logger = logging.getLogger(__name__)
 
+PRECISIONS = ("fp32", "bf16", "int8")
+
+# Result key carrying per-call stage timings back to the scheduler, which
+# removes it before the result reaches callers.
+TIMINGS_KEY = "_timings"
+# Result key carrying the number of chunks a caption or query generated,
+# counted while decoding; removed by the scheduler like ``TIMINGS_KEY``.
+TOKENS_KEY = "_tokens"
+# Recently encoded images whose prompt state forget_image can still find.
+MAX_IMAGE_CONTEXTS = 64
+# Concurrent sequences when max_sequences is left to fit the key/value pool.
+AUTO_MAX_SEQUENCES = 4
+
+DEFAULT_COMPILE_CACHE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "MoondreamStation",
+    "compile",
+)
+
+
+def _eager_fallback(inner, name: str, compiled: Callable, original: Callable):
+    """Call ``compiled``, switching ``inner.name`` back to ``original`` for good
+    if dynamo fails to compile a call, and answering that call eagerly."""
+    from torch._dynamo.exc import TorchDynamoException
+
+    def call(*args, **kwargs):
+        try:
+            return compiled(*args, **kwargs)
+        except TorchDynamoException as e:
+            # Each new input shape compiles lazily, inside a live request.
+            logger.warning(
+                f"torch.compile of {name} failed, falling back to eager: {e}"
+            )
+            setattr(inner, name, original)
+            return original(*args, **kwargs)
+
+    return call
+
 
 class ModelService:
-    def __init__(self, model_name: str, revision: str):
+    def __init__(
+        self,
+        model_name: str,
+        revision: str,
+        embedding_cache_bytes: int = 512 << 20,
+        precision: str = "fp32",
+        compile: bool = False,
+        compile_cache_dir: str = DEFAULT_COMPILE_CACHE,
+        max_sequences: int = 0,
+        kv_pool_bytes: int = 2048 << 20,
+        prefix_cache_bytes: int = 128 << 20,
+        tokenizer_cache_size: int = 4096,
+    ):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}'")
         self.model_name = model_name
         self.revision = revision
+        self.precision = precision
+        self.compiled = False
+        self.embedding_cache = EmbeddingCache(embedding_cache_bytes)
+        self.prefix_cache = PrefixCache(prefix_cache_bytes)
+        # Image digest -> prefix cache context of the recently encoded images.
+        self._image_contexts: "OrderedDict[str, tuple]" = OrderedDict()
+        self._image_contexts_lock = threading.Lock()
         self.device = self._get_best_device()
-        logger.info(f"Initializing model on device: {self.device}")
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            model_name, revision=revision, trust_remote_code=True
+        self.load_timings: Dict[str, float] = {}
+        logger.info(f"Initializing {precision} model on device: {self.device}")
+        start = time.perf_counter()
+
+        model_path = self._timed("resolve", self._resolve, model_name, revision)
+        self.tokenizer = self._timed(
+            "tokenizer",
+            AutoTokenizer.from_pretrained,
+            model_path,
+            revision=revision,
+            trust_remote_code=True,
+        )
+        # Safetensors weights are memory-mapped; low_cpu_mem_usage skips the
+        # random init and the extra copy from the checkpoint into the model.
+        self.model = self._timed(
+            "weights",
+            AutoModelForCausalLM.from_pretrained,
+            model_path,
+            revision=revision,
+            trust_remote_code=True,
+            low_cpu_mem_usage=True,
+            # Loading straight into bf16 avoids materialising fp32 weights first.
+            torch_dtype=torch.bfloat16 if precision == "bf16" else torch.float32,
         )
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name, revision=revision, trust_remote_code=True
+        if self.device != "cpu":
+            self._timed("device_move", self.model.to, self.device)
+        if precision == "int8":
+            self._timed("quantize", self._quantize_int8)
+
+        if compile:
+            self._timed("compile", self.compile_model, compile_cache_dir)
+
+        self.tokenizer_cache = self._cache_tokenizer(tokenizer_cache_size)
+        self.engine = self._make_engine(max_sequences, kv_pool_bytes)
+        if self.prefix_cache.max_bytes and not install_prefix_cache(
+            self.model, self.prefix_cache
+        ):
+            logger.warning("Model revision does not support prompt prefix caching")
+
+        self.load_timings["total"] = (time.perf_counter() - start) * 1000
+        logger.info(
+            json.dumps(
+                {
+                    "event": "model_load",
+                    "device": self.device,
+                    "precision": self.precision,
+                    "timings_ms": {
+                        phase: round(ms, 2) for phase, ms in self.load_timings.items()
+                    },
+                }
+            )
         )
-        self.model.to(self.device)
         logger.info(f"Model commit hash: {self.model.config._commit_hash}")
 
+    def _cache_tokenizer(self, max_entries: int) -> Optional[TokenizerCache]:
+        """Wrap the tokenizer the remote code calls with a ``TokenizerCache``.
+
+        Returns None, and leaves the tokenizer stats out, when the model
+        revision keeps no tokenizer of its own.
+        """
+        inner = getattr(self.model, "model", self.model)
+        tokenizer = getattr(inner, "tokenizer", None)
+        if tokenizer is None or not hasattr(tokenizer, "decode"):
+            logger.warning("Model revision does not support tokenizer caching")
+            return None
+        cache = TokenizerCache(tokenizer, max_entries)
+        inner.tokenizer = cache
+        return cache
+
+    def _make_engine(self, max_sequences: int, kv_pool_bytes: int):
+        """Iteration-level decode loop for captions and queries, if it pays.
+
+        ``kv_pool_bytes`` caps the key/value pool and with it the number of
+        concurrent sequences; 0 gives every sequence a slot. ``max_sequences``
+        of 0 takes as many as the pool fits, up to ``AUTO_MAX_SEQUENCES``.
+        When only one sequence fits or is asked for, or the model revision has
+        no per-block key/value caches, generations run directly on the calling
+        thread as before.
+        """
+        if max_sequences == 1:
+            return None
+        if not GenerationEngine.supported(self.model):
+            logger.warning(
+                "Model revision does not expose its key/value caches; "
+                "generating one sequence at a time"
+            )
+            return None
+        engine = GenerationEngine(
+            self.model, max_sequences or AUTO_MAX_SEQUENCES, kv_pool_bytes
+        )
+        if engine.max_sequences < 2:
+            logger.info(
+                f"Key/value pool of {kv_pool_bytes >> 20} MB fits one "
+                f"{engine.kv_bytes() >> 20} MB sequence; generating one at a time"
+            )
+            return None
+        logger.info(
+            f"Iteration-level generation: up to {engine.max_sequences} concurrent "
+            f"sequences, {engine.kv_bytes() / (1 << 20):.0f} MB of key/value "
+            f"buffers each, {engine.max_sequences * engine.kv_bytes() / (1 << 20):.0f} "
+            "MB pooled"
+        )
+        return engine
+
+    @property
+    def max_sequences(self) -> int:
+        """Generations that can run concurrently on this model instance."""
+        return self.engine.max_sequences if self.engine is not None else 1
+
+    def _exclusive(self):
+        """Context for model calls that must not interleave with decoding."""
+        return self.engine.exclusive() if self.engine is not None else nullcontext()
+
+    def _quantize_int8(self):
+        """Apply torchao int8 dynamic quantization to the model's linear layers.
+
+        Weights are stored as int8 and activations are quantized per token at
+        run time, roughly quartering the weight memory of the fp32 model.
+        """
+        from torchao.quantization import (
+            int8_dynamic_activation_int8_weight,
+            quantize_,
+        )
+
+        quantize_(self.model, int8_dynamic_activation_int8_weight())
+
+    def compile_model(self, cache_dir: str = DEFAULT_COMPILE_CACHE) -> bool:
+        """Compile the vision encoder and the single-token decode step.
+
+        Inductor artifacts are cached under ``cache_dir`` keyed by model
+        commit, torch version and device, so only the first boot of a given
+        combination pays the full compile cost. Any failure restores eager
+        execution, including a compile of a new input shape that fails later,
+        inside a request. Returns whether the model is now running compiled.
+        """
+        inner = getattr(self.model, "model", self.model)
+        targets = [
+            name for name in ("_vis_enc", "_decode_one_tok") if hasattr(inner, name)
+        ]
+        if not targets:
+            logger.warning("Model revision has no compilable entry points, using eager")
+            return False
+
+        commit = self.model.config._commit_hash or self.revision or "latest"
+        key = f"{commit}-torch{torch.__version__}-{self.device}".replace("+", "_")
+        cache_path = os.path.join(cache_dir, key)
+        os.makedirs(cache_path, exist_ok=True)
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_path
+        os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(cache_path, "triton"))
+        try:
+            import torch._inductor.config as inductor_config
+
+            inductor_config.fx_graph_cache = True
+        except (ImportError, AttributeError):
+            pass
+
+        from warmup import synthetic_image
+
+        image = synthetic_image()
+        eager_ms = self._per_token_ms(image)
+        originals = {name: getattr(inner, name) for name in targets}
+        start = time.perf_counter()
+        try:
+            for name in targets:
+                # Crop counts and prompt lengths vary between calls; let
+                # dynamo mark the dimensions it sees change as dynamic instead
+                # of recompiling for every new shape.
+                compiled = torch.compile(originals[name], dynamic=None)
+                setattr(
+                    inner, name, _eager_fallback(inner, name, compiled, originals[name])
+                )
+            # Compilation is lazy: the first call traces and builds the kernels.
+            self._per_token_ms(image)
+            compile_s = time.perf_counter() - start
+            compiled_ms = self._per_token_ms(image)
+        except Exception as e:
+            for name, func in originals.items():
+                setattr(inner, name, func)
+            logger.warning(f"torch.compile failed, falling back to eager: {e}")
+            return False
+
+        saved_ms = eager_ms - compiled_ms
+        payback = (
+            f"pays back after ~{compile_s * 1000 / saved_ms:.0f} tokens"
+            if saved_ms > 0
+            else "no per-token saving"
+        )
+        logger.info(
+            f"Compiled {', '.join(targets)} in {compile_s:.1f} s (cache {cache_path}); "
+            f"per-token latency {eager_ms:.2f} ms -> {compiled_ms:.2f} ms, {payback}"
+        )
+        self.compiled = True
+        return True
+
+    def _per_token_ms(self, image: Image.Image, max_tokens: int = 16) -> float:
+        """Average streamed decode latency per token for a short caption."""
+        settings = {"max_tokens": max_tokens, "temperature": 0}
+        # Call the model directly so the vision encoder runs every time.
+        tokens = self.model.caption(
+            image, length="short", stream=True, settings=settings
+        )["caption"]
+        first = None
+        count = 0
+        for _ in tokens:
+            if first is None:
+                first = time.perf_counter()
+            count += 1
+        if count < 2:
+            return 0.0
+        return (time.perf_counter() - first) * 1000 / (count - 1)
+
+    def _timed(self, phase: str, func, *args, **kwargs):
+        """Call ``func`` and record its wall time in ``load_timings``."""
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.load_timings[phase] = (time.perf_counter() - start) * 1000
+
+    @staticmethod
+    def _resolve(model_name: str, revision: str) -> str:
+        """Return the local snapshot directory for the model revision.
+
+        An already-downloaded revision then loads without any hub requests. On
+        a cache miss the model name is returned so ``from_pretrained`` fetches
+        just the files it needs, as before.
+        """
+        try:
+            return snapshot_download(
+                model_name, revision=revision, local_files_only=True
+            )
+        except LocalEntryNotFoundError:
+            logger.info(f"Revision {revision} not in local cache, using the hub")
+            return model_name
+
     @staticmethod
     def _get_best_device() -> str:
         """Determine the best available device: CUDA, then MPS, then CPU."""
@@ -31,9 +339,91 @@ class ModelService:
         else:
             return "cpu"
 
+    def cache_snapshots(self) -> Dict[str, dict]:
+        """Stats of the caches kept alongside the model, by cache name."""
+        snapshots = {
+            "embedding": self.embedding_cache.snapshot(),
+            "prefix": self.prefix_cache.snapshot(),
+        }
+        if self.tokenizer_cache is not None:
+            snapshots["tokenizer"] = self.tokenizer_cache.snapshot()
+        return snapshots
+
+    def clear_caches(self, names: Iterable[str]):
+        """Empty the named caches, e.g. ``("prefix",)``."""
+        for name in names:
+            cache = getattr(self, f"{name}_cache")
+            if cache is not None:
+                cache.clear()
+
+    def forget_image(self, image: Image.Image):
+        """Drop what the caches hold for ``image``, e.g. warmup's synthetic one.
+
+        Never touches the model, so it is safe alongside running jobs: prompt
+        state is found by the context recorded when the image was encoded.
+        """
+        digest = image_digest(image)
+        self.embedding_cache.pop(digest)
+        with self._image_contexts_lock:
+            context = self._image_contexts.pop(digest, None)
+        if context is not None:
+            self.prefix_cache.discard_context(context)
+
+    def _remember_context(self, digest: str, encoded):
+        """Record the prefix cache context of an encoded image for forget_image."""
+        context = image_context(encoded)
+        if context is None:
+            return
+        with self._image_contexts_lock:
+            self._image_contexts[digest] = context
+            self._image_contexts.move_to_end(digest)
+            while len(self._image_contexts) > MAX_IMAGE_CONTEXTS:
+                self._image_contexts.popitem(last=False)
+
+    def share_memory(self):
+        """Move the model weights into shared memory so forked replicas map
+        the same pages instead of copying them."""
+        self.model.share_memory()
+
+    def encode(self, image: Image.Image):
+        """Encode an image with the vision encoder, reusing cached embeddings.
+
+        Returns the input unchanged when it is already encoded or when the
+        model revision has no ``encode_image``.
+        """
+        if not isinstance(image, Image.Image) or not hasattr(
+            self.model, "encode_image"
+        ):
+            return image
+        cached = self.embedding_cache.max_bytes
+        if not cached and not self.prefix_cache.max_bytes:
+            with self._exclusive():
+                return self.model.encode_image(image)
+        key = image_digest(image)
+        encoded = self.embedding_cache.get(key) if cached else None
+        if encoded is None:
+            with self._exclusive():
+                encoded = self.model.encode_image(image)
+            if cached:
+                self.embedding_cache.put(key, encoded, tensor_nbytes(encoded))
+        if self.prefix_cache.max_bytes:
+            self._remember_context(key, encoded)
+        return encoded
+
+    def _generate(self, task: str, image, stream: bool, **kwargs) -> dict:
+        """Run a caption or query through the generation engine."""
+        sequence = self.engine.start(task, image, kwargs)
+        text = iter(sequence) if stream else sequence.result()
+        return {STREAM_KEYS[task]: text}
+
     def caption(
         self, image: Image.Image, length: str, stream: bool = False, settings: dict = {}
     ) -> dict:
+        image = self.encode(image)
+        if self.engine is not None:
+            return self._generate(
+                "caption", image, stream, length=length, settings=settings
+            )
         return self.model.caption(
             image, length=length, stream=stream, settings=settings
         )
@@ -45,10 +435,128 @@ class ModelService:
         stream: bool = False,
         settings: dict = {},
     ) -> dict:
+        image = self.encode(image)
+        if self.engine is not None:
+            return self._generate(
+                "query", image, stream, question=question, settings=settings
+            )
         return self.model.query(image, question, stream, settings)
 
     def detect(self, image: Image.Image, obj: str, settings: dict = {}) -> dict:
-        return self.model.detect(image, obj, settings)
+        image = self.encode(image)
+        with self._exclusive():
+            return self.model.detect(image, obj, settings)
 
     def point(self, image: Image.Image, obj: str, settings: dict = {}) -> dict:
-        return self.model.point(image, obj, settings)
+        image = self.encode(image)
+        with self._exclusive():
+            return self.model.point(image, obj, settings)
+
+    def run_batch(self, task: str, items: List[Tuple[Image.Image, dict]]) -> list:
+        """Run a group of same-task requests back to back.
+
+        The model's remote code has no batched entry point, so items are
+        executed in order on the calling thread, except that captions and
+        queries all join the generation engine's decode loop together. A
+        failing item yields its exception in place of a result so the rest of
+        the batch still completes.
+        """
+        if self.engine is not None and task in STREAM_KEYS:
+            return self._run_generation_batch(task, items)
+        inference_func = getattr(self, task)
+        results: List[Any] = []
+        for image, kwargs in items:
+            try:
+                start = time.perf_counter()
+                encoded = self.encode(image)
+                encoded_at = time.perf_counter()
+                if task in STREAM_KEYS:
+                    # Stream internally so generated tokens are counted as
+                    # they are decoded rather than by re-tokenizing the text.
+                    result = inference_func(encoded, stream=True, **kwargs)
+                    chunks = list(result[STREAM_KEYS[task]])
+                    result[STREAM_KEYS[task]] = "".join(chunks)
+                    result[TOKENS_KEY] = len(chunks)
+                else:
+                    result = inference_func(encoded, **kwargs)
+                if isinstance(result, dict):
+                    result[TIMINGS_KEY] = {
+                        "encode": (encoded_at - start) * 1000,
+                        "generate": (time.perf_counter() - encoded_at) * 1000,
+                    }
+                results.append(result)
+            except Exception as e:
+                logger.error(f"Inference error ({task}): {e}")
+                results.append(e)
+        return results
+
+    def _run_generation_batch(
+        self, task: str, items: List[Tuple[Image.Image, dict]]
+    ) -> list:
+        started: List[Any] = []
+        for image, kwargs in items:
+            try:
+                start = time.perf_counter()
+                encoded = self.encode(image)
+                encoded_at = time.perf_counter()
+                sequence = self.engine.start(task, encoded, kwargs)
+                started.append((sequence, start, encoded_at))
+            except Exception as e:
+                started.append(e)
+
+        results: List[Any] = []
+        for entry in started:
+            if isinstance(entry, Exception):
+                logger.error(f"Inference error ({task}): {entry}")
+                results.append(entry)
+                continue
+            sequence, start, encoded_at = entry
+            try:
+                text = sequence.result()
+            except Exception as e:
+                logger.error(f"Inference error ({task}): {e}")
+                results.append(e)
+                continue
+            # Sequences in one batch decode side by side, each from the
+            # iteration that admitted it, after waiting for a free slot.
+            admitted_at = sequence.admitted_at or encoded_at
+            results.append(
+                {
+                    STREAM_KEYS[task]: text,
+                    TOKENS_KEY: len(sequence.chunks),
+                    TIMINGS_KEY: {
+                        "encode": (encoded_at - start) * 1000,
+                        "admit": (admitted_at - encoded_at) * 1000,
+                        "generate": (sequence.finished_at - admitted_at) * 1000,
+                    },
+                }
+            )
+        return results
+
+    def run_stream(
+        self, task: str, image, kwargs: dict, on_token: Callable[[str], None]
+    ) -> dict:
+        """Run a streaming task, passing each generated token to ``on_token``.
+
+        Returns a result carrying only the stage timings.
+        """
+        start = time.perf_counter()
+        encoded = self.encode(image)
+        encoded_at = time.perf_counter()
+        result = getattr(self, task)(encoded, stream=True, **kwargs)
+        tokens = result[STREAM_KEYS[task]]
+        try:
+            for token in tokens:
+                on_token(token)
+        finally:
+            # Stop generation now if on_token raised, rather than whenever
+            # the abandoned generator is collected.
+            close = getattr(tokens, "close", None)
+            if close is not None:
+                close()
+        return {
+            TIMINGS_KEY: {
+                "encode": (encoded_at - start) * 1000,
+                "generate": (time.perf_counter() - encoded_at) * 1000,
+            }
+        }
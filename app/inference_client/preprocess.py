@@ -0,0 +1,132 @@
+import asyncio
+import base64
+import logging
+import multiprocessing
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Union
+
+from PIL import Image
+
+from caches import bytes_digest
+from cpu_config import pin_thread
+from imaging import decode_image
+from metrics import DECODE_SECONDS
+
+logger = logging.getLogger("moondream2")
+
+
+def _decode(data: Union[bytes, str], is_base64: bool, shrink: bool) -> Image.Image:
+    start = time.perf_counter()
+    raw_bytes = base64.b64decode(data) if is_base64 else data
+    b64_ms = (time.perf_counter() - start) * 1000
+    image = decode_image(raw_bytes, shrink)
+    image.info["content_hash"] = bytes_digest(raw_bytes)
+    if is_base64:
+        image.info["b64_ms"] = b64_ms
+    return image
+
+
+def _decode_shared(name: str, size: int, is_base64: bool, shrink: bool) -> tuple:
+    """Process-pool entry point.
+
+    Reads the encoded image from shared memory and writes the decoded RGB
+    pixels into a new shared memory block owned by the caller.
+    """
+    shm = SharedMemory(name=name)
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    image = _decode(data, is_base64, shrink)
+
+    pixels = image.tobytes()
+    out = SharedMemory(create=True, size=max(1, len(pixels)))
+    try:
+        out.buf[: len(pixels)] = pixels
+    finally:
+        out.close()
+    return out.name, image.size, dict(image.info)
+
+
+class DecodePool:
+    """
+    Decodes uploads off the event loop on a pool of threads or processes.
+
+    PIL and libvips release the GIL while decoding, so threads scale on most
+    hosts. Process mode moves the remaining Python-side work (base64, hashing,
+    RGB conversion) off the server process as well. Encoded bytes and decoded
+    pixels are passed through shared memory rather than pickled.
+    """
+
+    def __init__(
+        self,
+        mode: str = "thread",
+        workers: int = 4,
+        shrink: bool = True,
+        cpus: Optional[List[int]] = None,
+    ):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown decode pool mode '{mode}'")
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.shrink = shrink
+        # Keep decoding on the CPUs the model workers leave free.
+        pinning = {"initializer": pin_thread, "initargs": (cpus,)} if cpus else {}
+        if mode == "process":
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                **pinning,
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix="moondream-decode",
+                **pinning,
+            )
+        logger.info(f"Decode pool started ({self.workers} {mode} workers)")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def decode(
+        self, data: Union[bytes, str], is_base64: bool = False
+    ) -> Image.Image:
+        """Decode raw image bytes, or a base64 string, into an RGB image."""
+        loop = asyncio.get_running_loop()
+        if self.mode == "thread":
+            image = await loop.run_in_executor(
+                self._executor, _decode, data, is_base64, self.shrink
+            )
+            DECODE_SECONDS.observe(image.info["decode_ms"] / 1000)
+            return image
+
+        if isinstance(data, str):
+            data = data.encode("ascii")
+        shm = SharedMemory(create=True, size=max(1, len(data)))
+        try:
+            shm.buf[: len(data)] = data
+            name, size, info = await loop.run_in_executor(
+                self._executor,
+                _decode_shared,
+                shm.name,
+                len(data),
+                is_base64,
+                self.shrink,
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+
+        out = SharedMemory(name=name)
+        try:
+            image = Image.frombytes("RGB", size, out.buf[: size[0] * size[1] * 3])
+        finally:
+            out.close()
+            out.unlink()
+        image.info.update(info)
+        DECODE_SECONDS.observe(image.info["decode_ms"] / 1000)
+        return image
@@ -0,0 +1,221 @@
+import logging
+import multiprocessing
+import signal
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from cpu_config import ReplicaPlan, pin_thread
+from scheduler import GenerationCancelled
+
+logger = logging.getLogger("moondream2")
+
+# Model service methods the parent may call on a replica while it runs jobs.
+CONTROL_METHODS = ("cache_snapshots", "clear_caches", "forget_image")
+
+
+def _serve_control(conn, model_service):
+    """Answer cache requests from the parent alongside the job loop."""
+    while True:
+        try:
+            method, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            if method not in CONTROL_METHODS:
+                raise ValueError(f"Unknown replica control method '{method}'")
+            conn.send(("result", getattr(model_service, method)(*args)))
+        except Exception as e:
+            conn.send(("error", e))
+
+
+def _replica_main(
+    conn,
+    control_conn,
+    model_service,
+    plan: ReplicaPlan,
+    compile_cache_dir: Optional[str] = None,
+):
+    """Entry point of a replica process: serve jobs from ``conn`` until closed."""
+    # Shutdown is driven by the parent closing the pipe, not by terminal signals.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    pin_thread(plan.cpus, plan.intra_op_threads)
+    threading.Thread(
+        target=_serve_control,
+        args=(control_conn, model_service),
+        name="moondream-control",
+        daemon=True,
+    ).start()
+    if compile_cache_dir is not None:
+        model_service.compile_model(compile_cache_dir)
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        if message == "cancel":
+            continue  # The stream it was meant for already finished.
+        kind, task, payload = message
+        try:
+            if kind == "batch":
+                conn.send(("result", model_service.run_batch(task, payload)))
+            else:
+                image, kwargs = payload
+
+                def send_token(token: str):
+                    # The parent sends "cancel" when the client has gone away.
+                    if conn.poll() and conn.recv() == "cancel":
+                        raise GenerationCancelled()
+                    conn.send(("token", token))
+
+                result = model_service.run_stream(task, image, kwargs, send_token)
+                conn.send(("result", result))
+        except Exception as e:
+            conn.send(("error", e))
+
+
+class ReplicaWorker:
+    """
+    Scheduler worker backed by a forked model replica process.
+
+    Exposes the same interface as ``scheduler.LocalWorker``; the calling thread
+    blocks on the pipe to the replica while it runs.
+    """
+
+    def __init__(
+        self,
+        index: int,
+        model_service,
+        plan: ReplicaPlan,
+        compile_cache_dir: Optional[str] = None,
+    ):
+        ctx = multiprocessing.get_context("fork")
+        self.conn, child_conn = ctx.Pipe()
+        # Cache requests go over their own pipe so they need not wait for the
+        # job in progress.
+        self.control, child_control = ctx.Pipe()
+        self._control_lock = threading.Lock()
+        self.name = f"replica-{index}"
+        self.plan = plan
+        self.in_flight = 0
+        # The pipe carries one job at a time.
+        self.slots = 1
+        self.busy = 0
+        # Forked, so the replica maps the parent's shared-memory weights
+        # instead of receiving a pickled copy.
+        self.process = ctx.Process(
+            target=_replica_main,
+            args=(child_conn, child_control, model_service, plan, compile_cache_dir),
+            name=f"moondream-{self.name}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        child_control.close()
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"moondream-{self.name}"
+        )
+
+    def _receive(self):
+        try:
+            kind, value = self.conn.recv()
+        except EOFError:
+            raise RuntimeError(f"Model {self.name} exited unexpectedly")
+        if kind == "error":
+            raise value
+        return kind, value
+
+    def run_batch(self, task: str, items: list) -> list:
+        if task == "encode":
+            # Encodings cannot usefully cross the process boundary; the
+            # replica's own embedding cache shares them between its tasks.
+            return [image for image, _ in items]
+        self.conn.send(("batch", task, items))
+        return self._receive()[1]
+
+    def _call(self, method: str, *args):
+        with self._control_lock:
+            self.control.send((method, args))
+            try:
+                kind, value = self.control.recv()
+            except EOFError:
+                raise RuntimeError(f"Model {self.name} exited unexpectedly")
+        if kind == "error":
+            raise value
+        return value
+
+    def cache_snapshots(self) -> Dict[str, dict]:
+        return self._call("cache_snapshots")
+
+    def clear_caches(self, names):
+        self._call("clear_caches", tuple(names))
+
+    def forget_image(self, image):
+        self._call("forget_image", image)
+
+    def run_stream(
+        self, task: str, image, kwargs: dict, on_token: Callable[[str], None]
+    ) -> dict:
+        self.conn.send(("stream", task, (image, kwargs)))
+        try:
+            while True:
+                kind, value = self._receive()
+                if kind == "result":
+                    return value
+                on_token(value)
+        except GenerationCancelled:
+            self.conn.send("cancel")
+            self._drain()
+            raise
+
+    def _drain(self):
+        """Discard the remaining messages of a cancelled stream."""
+        while True:
+            try:
+                kind, _ = self._receive()
+            except GenerationCancelled:
+                return
+            if kind == "result":
+                return
+
+    def shutdown(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def start_replicas(
+    model_service, plans: List[ReplicaPlan], compile_cache_dir: Optional[str] = None
+) -> List[ReplicaWorker]:
+    """Fork one model worker process per plan, sharing one copy of the weights.
+
+    Replicas are CPU only: the weights are moved into shared memory once and
+    every forked replica maps the same pages, each pinned to its own cores.
+    Call before starting threads in this process; a fork only copies the
+    calling thread, and locks held by the others stay locked in the replica.
+    With ``compile_cache_dir`` each replica compiles its model after the fork.
+    """
+    if model_service.device != "cpu":
+        raise ValueError(
+            f"Model replicas require the CPU device, not '{model_service.device}'"
+        )
+    model_service.share_memory()
+    workers = [
+        ReplicaWorker(index, model_service, plan, compile_cache_dir)
+        for index, plan in enumerate(plans)
+    ]
+    for worker in workers:
+        logger.info(
+            f"Started model {worker.name} on cpus {worker.plan.cpus or 'unpinned'}"
+        )
+    return workers
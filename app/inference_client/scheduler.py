@@ -0,0 +1,705 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from caches import merge_snapshots
+from cpu_config import ReplicaPlan, pin_thread
+from metrics import (
+    BATCH_SIZE,
+    CANCELLED_STREAMS,
+    CANCELLED_TOKENS,
+    DEADLINES_MISSED,
+    QUEUE_WAIT_SECONDS,
+    TIME_TO_FIRST_TOKEN,
+    TOKENS,
+    TOKENS_PER_SECOND,
+)
+from model_service import STREAM_KEYS, TIMINGS_KEY, TOKENS_KEY
+
+logger = logging.getLogger("moondream2")
+
+TASKS = ("encode", "caption", "query", "detect", "point")
+PRIORITIES = ("high", "low")
+
+_STREAM_END = object()
+
+
+class QueueFullError(Exception):
+    """Raised when the work queue is at capacity."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class GenerationCancelled(Exception):
+    """Raised on a model worker to stop a stream whose client has gone away."""
+
+    def __init__(self, tokens: int = 0):
+        # Passed through to args so the exception survives pickling.
+        super().__init__(tokens)
+        self.tokens = tokens
+
+    def __str__(self):
+        return f"Generation cancelled after {self.tokens} tokens"
+
+
+class DeadlineReached(GenerationCancelled):
+    """Raised on a model worker to stop a stream whose deadline has passed."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's deadline passes before it can run."""
+
+
+class TokenStream:
+    """Async iterator over a streaming job's tokens.
+
+    ``truncated`` is set once the stream ends early because its deadline
+    passed.
+    """
+
+    def __init__(self, job: "InferenceJob", tokens: AsyncIterator[str]):
+        self._job = job
+        self._tokens = tokens
+
+    def __aiter__(self):
+        return self._tokens
+
+    @property
+    def truncated(self) -> bool:
+        return self._job.truncated
+
+
+@dataclass
+class InferenceJob:
+    """A single task waiting to be run by the model."""
+
+    task: str
+    image: Any
+    kwargs: Dict[str, Any]
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    # Set for streaming jobs; tokens are pushed here from the model thread.
+    tokens: Optional[asyncio.Queue] = None
+    # Filled with queue and model stage durations (ms) when given.
+    timings: Optional[Dict[str, float]] = None
+    # Set for streaming jobs; checked by the model thread before each token.
+    cancel: Optional[threading.Event] = None
+    # time.perf_counter() value after which the job is dropped or truncated.
+    deadline: Optional[float] = None
+    truncated: bool = False
+    priority: str = "high"
+
+
+class PriorityJobQueue(asyncio.Queue):
+    """Job queue that serves high-priority jobs before low-priority ones.
+
+    While both classes are waiting, low-priority jobs still get
+    ``low_priority_share`` of the dequeues, and a low-priority job that has
+    waited ``max_low_priority_wait_ms`` is served next regardless, so bulk
+    work keeps moving under sustained interactive load. ``maxsize`` bounds
+    each class separately, so bulk producers waiting for room in their own
+    lane never take it from interactive requests.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 0,
+        low_priority_share: float = 0.2,
+        max_low_priority_wait_ms: float = 2000,
+    ):
+        self.low_priority_share = min(1.0, max(0.0, low_priority_share))
+        self.max_low_priority_wait_ms = max(0.0, max_low_priority_wait_ms)
+        self.lane_size = max(0, maxsize)
+        # The base class is left unbounded; lanes are bounded in put*().
+        super().__init__()
+
+    def _init(self, maxsize):
+        self._lanes = {priority: deque() for priority in PRIORITIES}
+        self._lane_putters = {priority: deque() for priority in PRIORITIES}
+        # Dequeues per class while both were waiting; reset when one empties.
+        self._contended = dict.fromkeys(PRIORITIES, 0)
+
+    def qsize(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def empty(self) -> bool:
+        return not any(self._lanes.values())
+
+    def lane_sizes(self) -> Dict[str, int]:
+        return {priority: len(lane) for priority, lane in self._lanes.items()}
+
+    def lane_full(self, priority: str) -> bool:
+        return 0 < self.lane_size <= len(self._lanes[priority])
+
+    def put_nowait(self, job: InferenceJob):
+        if self.lane_full(job.priority):
+            raise asyncio.QueueFull
+        super().put_nowait(job)
+
+    async def put(self, job: InferenceJob):
+        """Wait for room in the job's own lane, then queue it."""
+        putters = self._lane_putters[job.priority]
+        while self.lane_full(job.priority):
+            putter = asyncio.get_running_loop().create_future()
+            putters.append(putter)
+            try:
+                await putter
+            except BaseException:
+                putter.cancel()
+                if putter in putters:
+                    putters.remove(putter)
+                if not self.lane_full(job.priority) and not putter.cancelled():
+                    # Woken for a free place it cannot take; pass it on.
+                    self._wakeup_next(putters)
+                raise
+        self.put_nowait(job)
+
+    def _put(self, job: InferenceJob):
+        self._lanes[job.priority].append(job)
+
+    def _get(self) -> InferenceJob:
+        high, low = self._lanes["high"], self._lanes["low"]
+        if not high or not low:
+            self._contended = dict.fromkeys(PRIORITIES, 0)
+            return self._pop("high" if high else "low")
+        waited_ms = (time.perf_counter() - low[0].enqueued_at) * 1000
+        served = self._contended["low"] + 1
+        total = sum(self._contended.values()) + 1
+        if (
+            waited_ms >= self.max_low_priority_wait_ms
+            or served <= self.low_priority_share * total
+        ):
+            priority = "low"
+        else:
+            priority = "high"
+        self._contended[priority] += 1
+        return self._pop(priority)
+
+    def _pop(self, priority: str) -> InferenceJob:
+        job = self._lanes[priority].popleft()
+        self._wakeup_next(self._lane_putters[priority])
+        return job
+
+
+class BatchStats:
+    """Running statistics for the batches the scheduler has dispatched."""
+
+    def __init__(self, max_batch_size: int):
+        self.batches = 0
+        self.items = 0
+        self.size_histogram = [0] * (max_batch_size + 1)
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.total_run_ms = 0.0
+        self.last_batch = None
+
+    def record(self, task: str, size: int, waits_ms: List[float], run_ms: float):
+        self.batches += 1
+        self.items += size
+        self.size_histogram[min(size, len(self.size_histogram) - 1)] += 1
+        self.total_wait_ms += sum(waits_ms)
+        self.max_wait_ms = max(self.max_wait_ms, max(waits_ms))
+        self.total_run_ms += run_ms
+        self.last_batch = {
+            "task": task,
+            "size": size,
+            "max_wait_ms": round(max(waits_ms), 3),
+            "run_ms": round(run_ms, 3),
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": (
+                round(self.items / self.batches, 3) if self.batches else 0.0
+            ),
+            "batch_size_histogram": {
+                str(size): count
+                for size, count in enumerate(self.size_histogram)
+                if count
+            },
+            "avg_wait_ms": (
+                round(self.total_wait_ms / self.items, 3) if self.items else 0.0
+            ),
+            "max_wait_ms": round(self.max_wait_ms, 3),
+            "avg_batch_run_ms": (
+                round(self.total_run_ms / self.batches, 3) if self.batches else 0.0
+            ),
+            "last_batch": self.last_batch,
+        }
+
+
+class LocalWorker:
+    """Runs model calls for the scheduler on a dedicated thread in this process."""
+
+    def __init__(
+        self, model_service, name: str = "model", plan: Optional[ReplicaPlan] = None
+    ):
+        self.model_service = model_service
+        self.name = name
+        self.in_flight = 0
+        # One dispatch per concurrent sequence the model's decode loop can
+        # hold; other model calls serialise between its decode steps.
+        self.slots = getattr(model_service, "max_sequences", 1)
+        self.busy = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.slots,
+            thread_name_prefix=f"moondream-{name}",
+            initializer=pin_thread if plan else None,
+            initargs=(plan.cpus, plan.intra_op_threads) if plan else (),
+        )
+
+    def run_batch(self, task: str, items: list) -> list:
+        return self.model_service.run_batch(task, items)
+
+    def run_stream(
+        self, task: str, image, kwargs: dict, on_token: Callable[[str], None]
+    ) -> dict:
+        return self.model_service.run_stream(task, image, kwargs, on_token)
+
+    def cache_snapshots(self) -> Dict[str, dict]:
+        return self.model_service.cache_snapshots()
+
+    def clear_caches(self, names):
+        self.model_service.clear_caches(names)
+
+    def forget_image(self, image):
+        self.model_service.forget_image(image)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BatchScheduler:
+    """
+    Collects inference requests into micro-batches in front of ModelService.
+
+    Requests submitted within ``max_wait_ms`` of the first queued request are
+    gathered (up to ``max_batch_size``), grouped by task type, and handed to
+    ``ModelService.run_batch`` one group at a time.
+
+    Model calls run on worker threads (``LocalWorker``) or model replica
+    processes so the event loop stays free for health checks, uploads and
+    decoding. Each batch goes to the least-loaded worker with a free slot; a
+    local worker has a slot per sequence its generation engine can decode
+    at once, so captions and queries join a running decode loop. The queue in
+    front of the workers holds at most ``max_queue_size`` jobs of each
+    priority; beyond that ``submit`` and ``stream`` fail fast with
+    ``QueueFullError``. Jobs are
+    taken from it by priority, see ``PriorityJobQueue``.
+    """
+
+    def __init__(
+        self,
+        model_service,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 5,
+        max_queue_size: int = 64,
+        workers: Optional[list] = None,
+        low_priority_share: float = 0.2,
+        max_low_priority_wait_ms: float = 2000,
+    ):
+        self.model_service = model_service
+        self.workers = workers or [LocalWorker(model_service)]
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0.0, max_wait_ms)
+        self.max_queue_size = max(1, max_queue_size)
+        self.low_priority_share = low_priority_share
+        self.max_low_priority_wait_ms = max_low_priority_wait_ms
+        self.stats = BatchStats(self.max_batch_size)
+        self.rejected = 0
+        self._queue = None
+        self._task = None
+        self._idle = None
+        # Set whenever a worker slot frees up, for reserve() to recheck.
+        self._slot_freed = None
+        self._dispatches = set()
+
+    async def start(self):
+        self._queue = PriorityJobQueue(
+            self.max_queue_size,
+            self.low_priority_share,
+            self.max_low_priority_wait_ms,
+        )
+        self._idle = asyncio.Semaphore(sum(worker.slots for worker in self.workers))
+        self._slot_freed = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            f"Batch scheduler started (max_batch_size={self.max_batch_size}, "
+            f"max_wait_ms={self.max_wait_ms}, max_queue_size={self.max_queue_size}, "
+            f"workers={len(self.workers)}, "
+            f"low_priority_share={self._queue.low_priority_share})"
+        )
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for worker in self.workers:
+            worker.shutdown()
+
+    def _cache_holders(self) -> list:
+        # Local workers share this process's model service; count it once.
+        holders = {}
+        for worker in self.workers:
+            holders.setdefault(id(getattr(worker, "model_service", worker)), worker)
+        return list(holders.values())
+
+    def cache_snapshots(self) -> Dict[str, dict]:
+        """Stats of the model-side caches, combined across model replicas."""
+        per_worker = [worker.cache_snapshots() for worker in self._cache_holders()]
+        return {
+            name: merge_snapshots([snapshots[name] for snapshots in per_worker])
+            for name in per_worker[0]
+        }
+
+    def clear_caches(self, names):
+        """Empty the named model-side caches in every model replica."""
+        for worker in self._cache_holders():
+            worker.clear_caches(names)
+
+    def forget_image(self, image):
+        """Drop ``image``'s cached state in every model replica."""
+        for worker in self._cache_holders():
+            worker.forget_image(image)
+
+    @asynccontextmanager
+    async def reserve(self, worker):
+        """Hold one of ``worker``'s slots for a call made outside the queue.
+
+        Dispatch counts on every free slot, so work sent straight to a worker,
+        such as warmup, takes a slot too rather than overlapping real jobs.
+        """
+        while True:
+            await self._idle.acquire()
+            if worker.busy < worker.slots:
+                break
+            # A slot is free, but on another worker; wait for the next one.
+            self._idle.release()
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+        worker.busy += 1
+        try:
+            yield
+        finally:
+            self._free_slot(worker)
+
+    def _free_slot(self, worker):
+        worker.busy -= 1
+        self._idle.release()
+        self._slot_freed.set()
+
+    @property
+    def in_flight(self) -> int:
+        """Jobs currently running on a worker."""
+        return sum(worker.in_flight for worker in self.workers)
+
+    @property
+    def depth(self) -> int:
+        """Jobs waiting in the queue plus jobs currently on a worker."""
+        return (self._queue.qsize() if self._queue else 0) + self.in_flight
+
+    def estimated_wait_s(self) -> float:
+        """Seconds a new job is expected to wait before it starts running."""
+        avg_run_s = self.stats.snapshot()["avg_batch_run_ms"] / 1000
+        batches = math.ceil(self.depth / (self.max_batch_size * len(self.workers)))
+        return batches * avg_run_s
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog is expected to drain."""
+        return max(1, math.ceil(self.estimated_wait_s()))
+
+    def queue_snapshot(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "queued_by_priority": self._queue.lane_sizes() if self._queue else {},
+            "in_flight": self.in_flight,
+            "workers": [worker.in_flight for worker in self.workers],
+            "max_queue_size": self.max_queue_size,
+            "rejected": self.rejected,
+            "avg_wait_ms": self.stats.snapshot()["avg_wait_ms"],
+        }
+
+    @staticmethod
+    def _validate(job: InferenceJob):
+        if job.task not in TASKS:
+            raise ValueError(f"Unknown task '{job.task}'")
+        if job.priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{job.priority}'")
+
+    def _enqueue(self, job: InferenceJob):
+        self._validate(job)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFullError(self.retry_after())
+
+    async def submit(
+        self,
+        task: str,
+        image,
+        block: bool = False,
+        timings: Optional[dict] = None,
+        deadline: Optional[float] = None,
+        priority: str = "high",
+        **kwargs,
+    ) -> dict:
+        """Queue a task for the next batch and wait for its result.
+
+        With ``block`` the caller waits for room in the queue instead of
+        getting ``QueueFullError``; bulk producers use this for backpressure.
+        ``timings``, if given, receives the queue and model stage durations.
+        A job still queued at its ``deadline`` fails with ``DeadlineExceeded``.
+        ``priority`` is ``"high"`` or ``"low"``.
+        """
+        future = asyncio.get_running_loop().create_future()
+        job = InferenceJob(
+            task,
+            image,
+            kwargs,
+            future,
+            timings=timings,
+            deadline=deadline,
+            priority=priority,
+        )
+        if block:
+            self._validate(job)
+            await self._queue.put(job)
+        else:
+            self._enqueue(job)
+        return await future
+
+    def stream(
+        self,
+        task: str,
+        image,
+        timings: Optional[dict] = None,
+        deadline: Optional[float] = None,
+        priority: str = "high",
+        **kwargs,
+    ) -> TokenStream:
+        """Queue a streaming task and return an async iterator over its tokens.
+
+        The job is enqueued immediately so a full queue is reported before the
+        response starts. Generation stops at ``deadline``, ending the stream
+        with ``truncated`` set.
+        """
+        if task not in STREAM_KEYS:
+            raise ValueError(f"Task '{task}' does not support streaming")
+        future = asyncio.get_running_loop().create_future()
+        job = InferenceJob(
+            task,
+            image,
+            kwargs,
+            future,
+            tokens=asyncio.Queue(),
+            timings=timings,
+            cancel=threading.Event(),
+            deadline=deadline,
+            priority=priority,
+        )
+        self._enqueue(job)
+        return TokenStream(job, self._iter_tokens(job))
+
+    @staticmethod
+    async def _iter_tokens(job: InferenceJob) -> AsyncIterator[str]:
+        first = None
+        count = 0
+        try:
+            while True:
+                token = await job.tokens.get()
+                if token is _STREAM_END:
+                    break
+                if first is None:
+                    first = time.perf_counter()
+                    TIME_TO_FIRST_TOKEN.observe(first - job.enqueued_at, task=job.task)
+                count += 1
+                yield token
+        finally:
+            # Reached early when the consumer stops iterating, e.g. because
+            # the client disconnected; the model thread stops at its next token.
+            if not job.future.done():
+                job.cancel.set()
+        if count:
+            TOKENS.inc(count, task=job.task)
+            elapsed = time.perf_counter() - first
+            if count > 1 and elapsed > 0:
+                TOKENS_PER_SECOND.observe((count - 1) / elapsed, task=job.task)
+        # Surfaces errors raised while the generator was running.
+        await job.future
+
+    async def _collect(self) -> List[InferenceJob]:
+        """Wait for one job, then gather more until the window or batch fills."""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Leave jobs in the queue until a worker is free, so that jobs
+            # arriving meanwhile are ordered by priority with them.
+            async with self._idle:
+                pass
+            batch = await self._collect()
+            groups = defaultdict(list)
+            streams = []
+            for job in batch:
+                if job.tokens is not None:
+                    streams.append(job)
+                else:
+                    groups[job.task].append(job)
+
+            work = [(self._run_group, task, jobs) for task, jobs in groups.items()]
+            work += [(self._run_stream, job.task, [job]) for job in streams]
+            for func, task, jobs in work:
+                # Wait for a worker to free up; new arrivals keep queueing
+                # meanwhile and form the next, fuller batch.
+                await self._idle.acquire()
+                # Skip jobs whose caller stopped waiting, e.g. a cancelled
+                # batch item, and those past their deadline.
+                jobs = [
+                    job
+                    for job in jobs
+                    if not job.future.done() and not self._expire(job)
+                ]
+                if not jobs:
+                    self._idle.release()
+                    continue
+                worker = min(
+                    (w for w in self.workers if w.busy < w.slots),
+                    key=lambda w: w.in_flight,
+                )
+                worker.busy += 1
+                worker.in_flight += len(jobs)
+                dispatch = asyncio.create_task(
+                    self._dispatch(loop, worker, func, task, jobs)
+                )
+                self._dispatches.add(dispatch)
+                dispatch.add_done_callback(self._dispatches.discard)
+
+    @staticmethod
+    def _expire(job: InferenceJob) -> bool:
+        """Drop a job whose deadline passed while it was queued."""
+        if job.deadline is None or time.perf_counter() < job.deadline:
+            return False
+        DEADLINES_MISSED.inc(task=job.task, stage="queue")
+        if job.tokens is not None:
+            # Streams end empty but cleanly, flagged as truncated.
+            job.truncated = True
+            job.future.set_result({})
+            job.tokens.put_nowait(_STREAM_END)
+        else:
+            job.future.set_exception(
+                DeadlineExceeded("Deadline passed before the request could start")
+            )
+        return True
+
+    async def _dispatch(self, loop, worker, func, task: str, jobs: List[InferenceJob]):
+        start = time.perf_counter()
+        waits_ms = [(start - job.enqueued_at) * 1000 for job in jobs]
+        try:
+            results = await loop.run_in_executor(
+                worker.executor, func, worker, jobs, loop
+            )
+        except Exception as e:
+            results = [e] * len(jobs)
+        finally:
+            worker.in_flight -= len(jobs)
+            self._free_slot(worker)
+        run_ms = (time.perf_counter() - start) * 1000
+
+        self.stats.record(task, len(jobs), waits_ms, run_ms)
+        BATCH_SIZE.observe(len(jobs), task=task)
+        for job, wait_ms in zip(jobs, waits_ms):
+            QUEUE_WAIT_SECONDS.observe(wait_ms / 1000, task=task, priority=job.priority)
+        logger.debug(
+            f"Batch {task}: size={len(jobs)} max_wait={max(waits_ms):.2f} ms "
+            f"run={run_ms:.2f} ms"
+        )
+
+        for job, result, wait_ms in zip(jobs, results, waits_ms):
+            stages = tokens = None
+            if isinstance(result, dict):
+                stages = result.pop(TIMINGS_KEY, None)
+                tokens = result.pop(TOKENS_KEY, None)
+            if tokens is not None:
+                TOKENS.inc(tokens, task=task)
+            if job.timings is not None:
+                job.timings["queue"] = wait_ms
+                job.timings.update(stages or {})
+            if job.future.done():
+                continue
+            if isinstance(result, DeadlineReached):
+                # The stream still ends normally, so _iter_tokens counts its tokens.
+                DEADLINES_MISSED.inc(task=task, stage="generation")
+                job.truncated = True
+                job.future.set_result({})
+                job.tokens.put_nowait(_STREAM_END)
+                continue
+            if isinstance(result, GenerationCancelled):
+                CANCELLED_STREAMS.inc(task=task)
+                CANCELLED_TOKENS.inc(result.tokens, task=task)
+                TOKENS.inc(result.tokens, task=task)
+                logger.info(f"Stopped {task} stream after {result.tokens} tokens")
+                job.future.cancel()
+                continue
+            if isinstance(result, Exception):
+                job.future.set_exception(result)
+            else:
+                job.future.set_result(result)
+            if job.tokens is not None:
+                job.tokens.put_nowait(_STREAM_END)
+
+    @staticmethod
+    def _run_group(worker, jobs: List[InferenceJob], loop) -> list:
+        """Runs on the worker's thread."""
+        return worker.run_batch(jobs[0].task, [(job.image, job.kwargs) for job in jobs])
+
+    @staticmethod
+    def _run_stream(worker, jobs: List[InferenceJob], loop) -> list:
+        """Runs on the worker's thread, forwarding tokens to the event loop."""
+        job = jobs[0]
+        generated = 0
+        if job.cancel.is_set():
+            raise GenerationCancelled(generated)
+
+        def on_token(token: str):
+            nonlocal generated
+            if job.cancel.is_set():
+                raise GenerationCancelled(generated)
+            if job.deadline is not None and time.perf_counter() >= job.deadline:
+                raise DeadlineReached(generated)
+            generated += 1
+            loop.call_soon_threadsafe(job.tokens.put_nowait, token)
+
+        return [worker.run_stream(job.task, job.image, job.kwargs, on_token)]